@@ -2,13 +2,19 @@ from typing import Callable
 import random
 from enum import Enum
 
+import numpy as np
+
 from algorithms.algorithm import Algorithm
 from algorithms.dp.policy_iteration import PolicyIterationAlgorithm
 from algorithms.dp.value_iteration import ValueIterationAlgorithm
+from algorithms.dp.shortest_path import ShortestPathAlgorithm
 from algorithms.mc.mcc import MonteCarloAlgorithm
 from algorithms.td.sarsa import TDSarsaAlgorithm
 from algorithms.td.q_learning import QLearningAlgorithm
-from algorithms.utils import Observation, sample_policy_action
+from algorithms.td.linear import LinearTDAlgorithm
+from algorithms.policy import Policy
+from algorithms.utils import Observation, TransitionModel, UniformStream, sample_policy_action
+from math_utils import ACTIONS, decode_state, encode_state
 
 class AgentAlgorithm(Enum):
     POLICY_ITERATION = 0
@@ -16,63 +22,106 @@ class AgentAlgorithm(Enum):
     MONTE_CARLO = 2
     SARSA = 3
     Q_LEARNING = 4
+    SHORTEST_PATH = 5
+    LINEAR_TD = 6
 
 class Agent:
-    def __init__(self, grid_action_cb: Callable[[tuple[int, int], tuple[int, int]], Observation], 
-                 grid_pos: tuple[int, int] = (0, 0), grid_size: int = 8, img: str = "robot.png"):
+    def __init__(self, grid_action_cb: Callable[[int, int], Observation], 
+                 grid_pos: tuple[int, int] = (0, 0), grid_size: int = 8, img: str = "robot.png",
+                 model_cb: Callable[[], TransitionModel] = None, rng: np.random.Generator = None):
         self.img = img
-        self.grid_pos: tuple[int, int] = grid_pos
         self.grid_size = grid_size
-        self.grid_action_cb: Callable[[tuple[int, int], tuple[int, int]], Observation] = grid_action_cb
+        # The agent's state is kept as a flat state id (s = y * grid_size + x).
+        self.state: int = encode_state(grid_pos, grid_size)
+        self.grid_action_cb: Callable[[int, int], Observation] = grid_action_cb
+        # Optional callback returning the environment's compiled transition tables (see SchoolEnv.transition_model).
+        self.model_cb: Callable[[], TransitionModel] = model_cb
+        # Random generator of the agent (e.g. the environment's np_random), the algorithms spawn their own from it.
+        self.rng: np.random.Generator = rng if rng is not None else np.random.default_rng()
+        self.uniforms: UniformStream = UniformStream(self.rng)
 
-        self.policy: dict[tuple[int, int], dict[tuple[int, int], float]] = dict()
+        # The policy is compiled for sampling, changes to it are picked up when it is sampled next. It is only built
+        # (by set_algorithm) for the algorithms that keep a table, the linear learner does without one.
+        self.policy: Policy = None
 
         self.algorithm = None
 
-        self.init_policy()
+    @property
+    def grid_pos(self) -> tuple[int, int]:
+        """Grid position (x, y) of the agent, for rendering."""
+        return decode_state(self.state, self.grid_size)
 
     def init_policy(self):
-        for x in range(0, self.grid_size):
-            for y in range(0, self.grid_size):
-                self.policy[(x, y)] = dict()
-                if x > 0:
-                    self.add_policy_action((x, y), (-1, 0))
-                if x < self.grid_size - 1:
-                    self.add_policy_action((x, y), (1, 0))
-                if y > 0:
-                    self.add_policy_action((x, y), (0, -1))
-                if y < self.grid_size - 1:
-                    self.add_policy_action((x, y), (0, 1))
-
-                probability: float = 1 / len(self.policy[(x, y)])
-                for key in self.policy[(x, y)]:
-                    self.policy[(x, y)][key] = probability
-
-    def add_policy_action(self, state: tuple[int, int], action: tuple[int, int]) -> tuple[int, int]:
+        if self.policy is None:
+            self.policy = Policy(self.grid_size * self.grid_size)
+
+        for s in range(self.grid_size * self.grid_size):
+            self.policy[s] = dict()
+            for action in range(len(ACTIONS)):
+                self.add_policy_action(s, action)
+
+            probability: float = 1 / len(self.policy[s])
+            for key in self.policy[s]:
+                self.policy[s][key] = probability
+
+    def add_policy_action(self, state: int, action: int) -> None:
         obs: Observation = self.grid_action_cb(state, action)
 
-        if (state != obs.grid_pos):
+        # Only actions that actually move the agent (not off the grid or into a solid) are added.
+        if (state != obs.state):
             self.policy[state][action] = 0
     
-    def sample_action(self, grid_pos: tuple[int, int] = None) -> tuple[int, int]:
-        return sample_policy_action(self.policy, self.grid_pos if grid_pos is None else grid_pos)
+    def sample_action(self, state: int = None) -> int:
+        state = self.state if state is None else state
+
+        # A linear learner does not store its policy, its greedy action is computed when it is needed.
+        if isinstance(self.algorithm, LinearTDAlgorithm) and self.algorithm.weights is not None:
+            return self.algorithm.greedy_action(state)
+
+        if self.policy is None:
+            # No policy was built (e.g. the linear learner before it ran): a uniform choice of the actions that move the agent.
+            actions: list[int] = [action for action in range(len(ACTIONS)) if self.grid_action_cb(state, action).state != state]
+            if not actions:
+                raise ValueError("State {} has no action that moves the agent".format(state))
+
+            return actions[self.uniforms.integer(len(actions))]
+
+        return sample_policy_action(self.policy, state, self.uniforms)
 
     def set_algorithm(self, algorithm : AgentAlgorithm):
+        if algorithm != AgentAlgorithm.LINEAR_TD and self.policy is None:
+            self.init_policy()
+
         match algorithm:
             case AgentAlgorithm.POLICY_ITERATION:
-                self.algorithm = PolicyIterationAlgorithm(self.policy, self.grid_action_cb, self.grid_pos, self.grid_size)
+                self.algorithm = PolicyIterationAlgorithm(self.policy, self.grid_action_cb, self.state, self.grid_size, self.model_cb, self.rng)
             
             case AgentAlgorithm.VALUE_ITERATION:
-                self.algorithm = ValueIterationAlgorithm(self.policy, self.grid_action_cb, self.grid_pos, self.grid_size)
+                self.algorithm = ValueIterationAlgorithm(self.policy, self.grid_action_cb, self.state, self.grid_size, self.model_cb, self.rng)
 
             case AgentAlgorithm.MONTE_CARLO:
-                self.algorithm = MonteCarloAlgorithm(self.policy, self.grid_action_cb, self.grid_pos, self.grid_size)
+                self.algorithm = MonteCarloAlgorithm(self.policy, self.grid_action_cb, self.state, self.grid_size, self.model_cb, self.rng)
 
             case AgentAlgorithm.SARSA:
-                self.algorithm = TDSarsaAlgorithm(self.policy, self.grid_action_cb, self.grid_pos, self.grid_size)
+                self.algorithm = TDSarsaAlgorithm(self.policy, self.grid_action_cb, self.state, self.grid_size, self.model_cb, self.rng)
 
             case AgentAlgorithm.Q_LEARNING:
-                self.algorithm = QLearningAlgorithm(self.policy, self.grid_action_cb, self.grid_pos, self.grid_size)
+                self.algorithm = QLearningAlgorithm(self.policy, self.grid_action_cb, self.state, self.grid_size, self.model_cb, self.rng)
+
+            case AgentAlgorithm.SHORTEST_PATH:
+                self.algorithm = ShortestPathAlgorithm(self.policy, self.grid_action_cb, self.state, self.grid_size, self.model_cb, self.rng)
+
+            case AgentAlgorithm.LINEAR_TD:
+                self.algorithm = LinearTDAlgorithm(self.policy, self.grid_action_cb, self.state, self.grid_size, self.model_cb, self.rng)
 
     def run_algorithm(self, **kwargs):
-        self.algorithm.run(**kwargs)
\ No newline at end of file
+        self.algorithm.run(**kwargs)
+
+    def replan(self, changed_states: list[int]) -> list[int]:
+        """Repairs the current solution after the environment changed, see SchoolEnv.update_cell.
+        Only supported by value iteration.
+        """
+        if not isinstance(self.algorithm, ValueIterationAlgorithm):
+            raise ValueError("Replanning is only supported by value iteration")
+
+        return self.algorithm.replan(changed_states)
\ No newline at end of file
@@ -3,16 +3,38 @@ from typing import Callable
 
 from abc import ABC, abstractmethod
 
-from algorithms.utils import Observation
+import numpy as np
+
+from algorithms.utils import Observation, TransitionModel, UniformStream, build_transition_model
 from cell import Cell
 
 class Algorithm(ABC):
-    def __init__(self, policy: dict[tuple[int, int], dict[tuple[int, int], float]], grid_action_cb: Callable[[tuple[int, int], tuple[int, int]], Observation], 
-                 grid_pos: tuple[int, int], grid_size: int):
-        self.policy: dict[tuple[int, int], dict[tuple[int, int], float]] = policy
-        self.grid_action_cb: Callable[[tuple[int, int], tuple[int, int]], Observation] = grid_action_cb
-        self.grid_pos: tuple[int, int] = grid_pos
+    def __init__(self, policy: dict[int, dict[int, float]], grid_action_cb: Callable[[int, int], Observation], 
+                 state: int, grid_size: int, model_cb: Callable[[], TransitionModel] = None, rng: np.random.Generator = None):
+        # States and actions are flat ids, see math_utils.encode_state and math_utils.ACTIONS.
+        self.policy: dict[int, dict[int, float]] = policy
+        self.grid_action_cb: Callable[[int, int], Observation] = grid_action_cb
+        self.state: int = state
         self.grid_size: int = grid_size
+        # Optional callback returning the environment's compiled transition tables.
+        self.model_cb: Callable[[], TransitionModel] = model_cb
+        # The algorithm's own random generator, spawned from the given one (e.g. the environment's np_random),
+        # so that a seeded environment gives reproducible runs. Samplers draw from its block-drawn uniforms.
+        self.rng: np.random.Generator = rng.spawn(1)[0] if rng is not None else np.random.default_rng()
+        self.uniforms: UniformStream = UniformStream(self.rng)
+
+    def seed(self, seed: int = None) -> None:
+        """Restarts the random generator from the seed, if one is given."""
+        if seed is not None:
+            self.rng = np.random.default_rng(seed)
+            self.uniforms = UniformStream(self.rng)
+
+    def transition_model(self) -> TransitionModel:
+        """The transition tables of the environment. Without a model callback they are built by querying grid_action_cb."""
+        if self.model_cb is not None:
+            return self.model_cb()
+
+        return build_transition_model(self.grid_action_cb, self.grid_size * self.grid_size)
 
     @abstractmethod
     def run(self):
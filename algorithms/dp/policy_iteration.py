@@ -1,108 +1,185 @@
 from abc import ABC
 from typing import Callable
 
-from algorithms.algorithm import Algorithm
-from algorithms.utils import Observation
+import numpy as np
 
-class PolicyIterationAlgorithm(Algorithm):
-    def __init__(self, policy: dict[tuple[int, int], dict[tuple[int, int], float]], grid_action_cb: Callable[[tuple[int, int], tuple[int, int]], Observation], 
-                 grid_pos: tuple[int, int], grid_size: int):
-        super().__init__(policy, grid_action_cb, grid_pos, grid_size)
+try:
+    import scipy.sparse
+    import scipy.sparse.linalg
+except ImportError:
+    scipy = None
 
-        self.potential_rewards: dict[tuple[int, int], float] = dict()
+from algorithms.algorithm import Algorithm
+from algorithms.utils import Observation, TransitionModel, policy_matrix
+from math_utils import ACTIONS
 
-    def run(self, gamma_factor: float = 0.95, theta_factor: float = 0.001):
+class PolicyIterationAlgorithm(Algorithm):
+    def __init__(self, policy: dict[int, dict[int, float]], grid_action_cb: Callable[[int, int], Observation], 
+                 state: int, grid_size: int, model_cb: Callable[[], TransitionModel] = None, rng: np.random.Generator = None):
+        super().__init__(policy, grid_action_cb, state, grid_size, model_cb, rng)
+
+        self.potential_rewards: dict[int, float] = dict()
+
+        # Work done by the last run: policy evaluation sweeps, policy improvement steps
+        # and the largest value change in the last evaluation sweep.
+        self.num_sweeps: int = 0
+        self.num_improvements: int = 0
+        self.evaluation_delta: float = 0.0
+
+    def run(self, gamma_factor: float = 0.95, theta_factor: float = 0.001, evaluation: str = "sweep", evaluation_sweeps: int = None):
+        """Runs policy iteration. The policy is evaluated either with in-place sweeps until convergence ("sweep"),
+        exactly, by solving the linear system of the policy's Bellman equation ("linear"), or as modified policy
+        iteration ("modified"): every evaluation starts from the previous values and stops after evaluation_sweeps
+        sweeps. Without evaluation_sweeps the number of sweeps is adaptive: it starts at 1 and doubles every time
+        an improvement step leaves the policy unchanged while the values have not converged yet.
+        """
         policy_stable = False
         self.potential_rewards = dict()
 
+        self.num_sweeps = 0
+        self.num_improvements = 0
+
+        sweeps: int = 1 if evaluation_sweeps is None else evaluation_sweeps
+
         # While the policy is not stable, it is not optimal yet.
         while not policy_stable:
             # The policy is set to stable so that if no value is changed the loop stops.
             policy_stable = True
-            self.potential_rewards = self.evaluate_policy(gamma_factor, theta_factor)
+
+            match evaluation:
+                case "sweep":
+                    self.potential_rewards = self.evaluate_policy(gamma_factor, theta_factor)
+                case "linear":
+                    self.potential_rewards = self.evaluate_policy_linear(gamma_factor, theta_factor)
+                case "modified":
+                    self.potential_rewards = self.evaluate_policy(gamma_factor, theta_factor, self.potential_rewards or None, sweeps)
+                case _:
+                    raise ValueError("Unknown policy evaluation method '{}'".format(evaluation))
 
             # Iterate for each cell in the grid.
-            for x in range(self.grid_size):
-                for y in range(self.grid_size):
-                    # Get the cell associated with the coordinate (s).
-                    curr_state: Observation = self.grid_action_cb((x,y), None)
+            for s in range(self.grid_size * self.grid_size):
+                # Get the cell associated with the state (s).
+                curr_state: Observation = self.grid_action_cb(s, None)
+
+                if curr_state.is_terminal:
+                    continue
+
+                # Save the current actions.
+                old_actions: dict[int, float] = self.policy[s]
+                # A dictionary of the new evaluated actions.
+                eval_actions: dict[int, float] = {}
 
-                    if curr_state.is_terminal:
+                # Iterate over each action that moves the agent, not only the ones in the current policy.
+                for action in range(len(ACTIONS)):
+                    # Get the new state based on the action and the current state.
+                    next_state: Observation = self.grid_action_cb(s, action)
+
+                    if next_state.state == s:
                         continue
 
-                    # Save the current actions.
-                    old_actions: dict[(int, int)] = self.policy[curr_state.grid_pos]
-                    # A dictionary of the new evaluated actions.
-                    eval_actions: dict[(int, int)] = {}
+                    # Calculate the new reward given the action.
+                    next_reward: float = next_state.reward + gamma_factor * self.potential_rewards[next_state.state]
+                    eval_actions[action] = next_reward
 
-                    s: tuple[int, int] = curr_state.grid_pos
+                # Get the best actions out of the new actions, if there are multiple best actions give them all.
+                # A small tolerance keeps rounding differences between evaluations from flipping ties back and forth.
+                best_value: float = max(eval_actions.values())
+                best_actions: list[int] = [action for action, reward in eval_actions.items() if
+                                           reward >= best_value - 1e-9]
+                # Distribute the probability evenly over the remaining actions.
+                action_prob: float = 1 / len(best_actions)
+                new_actions: dict[int, float] = {}
 
-                    # Iterate over each action possible in this cell.
-                    for action in self.policy[s]:
-                        # Create the new position based on the action and the current position.
-                        next_state: Observation = self.grid_action_cb(action, s)
-                        # Calculate the new reward given the action.
-                        next_reward: float = next_state.reward + gamma_factor * self.potential_rewards[next_state.grid_pos]
-                        eval_actions[action] = next_reward
+                for action in best_actions:
+                    new_actions[action] = action_prob
 
-                    # Get the best actions out of the new actions, if there are multiple best actions give them all.
-                    best_actions: list[(int, int)] = [action for action, reward in eval_actions.items() if
-                                                    reward == max(eval_actions.values())]
-                    # Distribute the probability evenly over the remaining actions.
-                    action_prob: float = 1 / len(best_actions)
-                    new_actions: dict[(int, int)] = {}
+                # If the actions have updated, mark the policy as stable to continue iterating.
+                if old_actions != new_actions:
+                    self.policy[s] = new_actions
+                    policy_stable = False
 
-                    for action in best_actions:
-                        new_actions[action] = action_prob
+            self.num_improvements += 1
 
-                    # If the actions have updated, mark the policy as stable to continue iterating.
-                    if old_actions != new_actions:
-                        self.policy[s] = new_actions
-                        policy_stable = False
+            # With truncated evaluations a stable policy is only optimal once its values have converged as well.
+            if evaluation == "modified" and policy_stable and self.evaluation_delta > theta_factor:
+                policy_stable = False
 
-                # Once the policy is done improving, return the possible rewards.
-                if policy_stable:
-                    return
+                if evaluation_sweeps is None:
+                    sweeps *= 2
 
     def terminate(self):
         return super().terminate()
 
-    def evaluate_policy(self, gamma: float = 0.8, theta: float = 0.001) -> dict[(int, int)]:
+    def evaluate_policy(self, gamma: float = 0.8, theta: float = 0.001, potential_rewards: dict[int, float] = None,
+                        max_sweeps: int = None) -> dict[int, float]:
         # If not provided with a list of possible rewards, initialize a list for the entire grid with value 0.
+        if potential_rewards is None:
+            potential_rewards = dict()
 
-        potential_rewards: dict[tuple[int, int], float] = dict()
-
-        for x in range(self.grid_size):
-            for y in range (self.grid_size):                
-                potential_rewards[(x, y)] = 0.0
+            for s in range(self.grid_size * self.grid_size):
+                potential_rewards[s] = 0.0
+        else:
+            potential_rewards = dict(potential_rewards)
 
+        sweeps: int = 0
         delta: float = theta + 1
-        while delta > theta:
+        while delta > theta and (max_sweeps is None or sweeps < max_sweeps):
             delta = 0
+            sweeps += 1
 
             # Iterate for each cell in the grid.
-            for x in range(self.grid_size):
-                for y in range(self.grid_size):
-                    v: float = 0
-                    # Get the cell associated with the coordinate (s).
-                    curr_state: Observation = self.grid_action_cb((x,y))
-
-                    if curr_state.is_terminal:
-                        continue
-
-                    s: tuple[int, int] = (x,y)
-
-                    # Iterate over each action possible in this cell.
-                    for action in self.policy[s]:
-                        # Combine coordinate and action to create the new position following the action.
-                        next_state = self.grid_action_cb(s, action)
-                        # In this simulation the actions are deterministic therefore it is multiplied by 1 instead of a probability.
-                        v += self.policy[s][action] * (
-                                    next_state.reward + gamma * potential_rewards[next_state.grid_pos])
-
-                    # Make the difference a positive number and replace it with delta if it is bigger.
-                    delta = max(delta, abs(v - potential_rewards[s]))
-                    # Add v as the possible reward for the coordinate s.
-                    potential_rewards[s] = v
-
-        return potential_rewards
\ No newline at end of file
+            for s in range(self.grid_size * self.grid_size):
+                v: float = 0
+                # Get the cell associated with the state (s).
+                curr_state: Observation = self.grid_action_cb(s)
+
+                if curr_state.is_terminal:
+                    continue
+
+                # Iterate over each action possible in this cell.
+                for action in self.policy[s]:
+                    # Combine state and action to get the new state following the action.
+                    next_state = self.grid_action_cb(s, action)
+                    # In this simulation the actions are deterministic therefore it is multiplied by 1 instead of a probability.
+                    v += self.policy[s][action] * (
+                                next_state.reward + gamma * potential_rewards[next_state.state])
+
+                # Make the difference a positive number and replace it with delta if it is bigger.
+                delta = max(delta, abs(v - potential_rewards[s]))
+                # Add v as the possible reward for the state s.
+                potential_rewards[s] = v
+
+        self.num_sweeps += sweeps
+        self.evaluation_delta = delta
+
+        return potential_rewards
+
+    def evaluate_policy_linear(self, gamma: float = 0.8, theta: float = 0.001) -> dict[int, float]:
+        """Evaluates the policy exactly by solving (I - gamma * P_pi) v = r_pi.
+        Uses a sparse direct solve when scipy is available, otherwise vectorized sweeps until the change is below theta.
+        """
+        model: TransitionModel = self.transition_model()
+        num_states: int = self.grid_size * self.grid_size
+
+        # Terminal states have no outgoing transitions, so their value stays 0.
+        probs: np.ndarray = policy_matrix(self.policy, num_states)
+        probs[model.terminal] = 0.0
+
+        r_pi: np.ndarray = np.sum(probs * model.reward, axis=1)
+
+        if scipy is not None:
+            # Duplicate (state, next state) entries, e.g. two actions bumping into walls, are summed.
+            p_pi = scipy.sparse.csr_matrix((probs.ravel(), (np.repeat(np.arange(num_states), len(ACTIONS)), model.next_state.ravel())),
+                                           shape=(num_states, num_states))
+            values = scipy.sparse.linalg.spsolve((scipy.sparse.identity(num_states, format="csr") - gamma * p_pi).tocsc(), r_pi)
+        else:
+            values = np.zeros(num_states)
+
+            delta: float = theta + 1
+            while delta > theta:
+                new_values = r_pi + gamma * np.sum(probs * values[model.next_state], axis=1)
+                delta = float(np.max(np.abs(new_values - values)))
+                values = new_values
+                self.num_sweeps += 1
+
+        return dict(enumerate(values.tolist()))
@@ -0,0 +1,92 @@
+import heapq
+from typing import Callable
+
+import numpy as np
+
+from algorithms.algorithm import Algorithm
+from algorithms.dp.value_iteration import bellman_backup, greedy_actions, masked_rewards, oscillation_values
+from algorithms.utils import Observation, TransitionModel, policy_action_mask, reverse_transitions
+
+class ShortestPathAlgorithm(Algorithm):
+    """Solves the grid in a single backward search from the terminal states, using that the transitions are
+    deterministic: the value of a state is the best discounted reward of a path, so values can be settled like the
+    distances in Dijkstra's algorithm, highest value first, instead of sweeping the whole grid until convergence.
+    """
+    def __init__(self, policy: dict[int, dict[int, float]], grid_action_cb: Callable[[int, int], Observation],
+                 state: int, grid_size: int, model_cb: Callable[[], TransitionModel] = None, rng: np.random.Generator = None):
+        super().__init__(policy, grid_action_cb, state, grid_size, model_cb, rng)
+        self.potential_rewards: dict[int, float] = dict()
+        self.optimal_actions: dict[int, int] = dict()
+
+        self.values: np.ndarray = None
+        # Number of states taken from the queue, equal to the number of states when every state is settled only once.
+        self.num_expansions: int = 0
+
+    def terminate(self):
+        return super().terminate()
+
+    def run(self, gamma_factor: float = 0.8, theta_factor: float = 0.001):
+        self.potential_rewards.clear()
+        self.optimal_actions.clear()
+        self.num_expansions = 0
+
+        model: TransitionModel = self.transition_model()
+        num_states: int = self.grid_size * self.grid_size
+
+        mask: np.ndarray = policy_action_mask(self.policy, num_states)
+        masked_reward: np.ndarray = masked_rewards(model.reward.astype(float), mask)
+        fixed: np.ndarray = model.terminal | ~mask.any(axis=1)
+        indptr, predecessors = reverse_transitions(model.next_state, mask)
+
+        # Start from values that can be achieved without searching (reaching an adjacent terminal state, or oscillating),
+        # states without any of those options start from the worst possible value.
+        # Without discounting oscillating has no finite value, then only paths into terminal states are searched.
+        if gamma_factor < 1.0:
+            lower_bound: float = min(float(masked_reward[mask].min()), 0.0) / (1.0 - gamma_factor) if mask.any() else 0.0
+            self.values = np.maximum(oscillation_values(model.next_state, masked_reward, model.terminal, gamma_factor), lower_bound)
+        else:
+            self.values = np.where(model.terminal, 0.0, -np.inf)
+
+        self.values = np.where(fixed, 0.0, self.values)
+
+        # Label-correcting search: a state whose value improved offers a better path to its predecessors.
+        # Taking the highest value first settles most states once, a state is only taken again when it improves later.
+        queue: list[tuple[float, int]] = [(-v, s) for s, v in enumerate(self.values.tolist())]
+        heapq.heapify(queue)
+
+        while True:
+            while queue:
+                value, s = heapq.heappop(queue)
+                if -value != self.values[s]:
+                    continue
+
+                self.num_expansions += 1
+
+                for p in predecessors[indptr[s]:indptr[s + 1]].tolist():
+                    if fixed[p]:
+                        continue
+
+                    candidate: float = float(np.max(masked_reward[p][model.next_state[p] == s])) + gamma_factor * self.values[s]
+                    if candidate > self.values[p]:
+                        self.values[p] = candidate
+                        heapq.heappush(queue, (-candidate, p))
+
+            # The search finds the best paths into terminal states and oscillations. Any state that can still be improved
+            # prefers a longer cycle, continue the search from there.
+            improved = np.flatnonzero(bellman_backup(self.values, model.next_state.T, masked_reward.T, fixed, gamma_factor) - self.values > theta_factor)
+
+            if len(improved) == 0:
+                break
+
+            for s in improved.tolist():
+                self.values[s] = float(np.max(masked_reward[s] + gamma_factor * self.values[model.next_state[s]]))
+                heapq.heappush(queue, (-self.values[s], s))
+
+        best_actions = greedy_actions(self.values, model.next_state.T, masked_reward.T, gamma_factor)
+
+        self.potential_rewards.update(enumerate(self.values.tolist()))
+        self.optimal_actions.update(zip(np.flatnonzero(~fixed).tolist(), best_actions[~fixed].tolist()))
+
+        for state in self.optimal_actions:
+            self.policy[state].clear()
+            self.policy[state][self.optimal_actions[state]] = 1.0
@@ -1,28 +1,261 @@
+import heapq
+import multiprocessing
 import operator
+import os
+from multiprocessing import shared_memory
 from typing import Callable
 
+import numpy as np
+
 from algorithms.algorithm import Algorithm
-from algorithms.utils import Observation
+from algorithms.utils import Observation, TransitionModel, policy_action_mask, reverse_transitions, valid_action_mask
+
+def masked_rewards(reward: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """The reward table with -inf for invalid actions, so that they never win a max."""
+    return np.where(mask, reward, -np.inf)
+
+def bellman_backup(values: np.ndarray, next_state: np.ndarray, masked_reward: np.ndarray,
+                   fixed: np.ndarray, gamma: float) -> np.ndarray:
+    """One synchronous Bellman optimality backup of every state at once. States marked as fixed
+    (terminal states, or states without any valid action) keep their value.
+    The tables are laid out action-major, (A, S), so that the max runs over contiguous rows.
+    """
+    best_values = np.max(masked_reward + gamma * values[next_state], axis=0)
+
+    return np.where(fixed, values, best_values)
+
+def greedy_actions(values: np.ndarray, next_state: np.ndarray, masked_reward: np.ndarray, gamma: float) -> np.ndarray:
+    """The best valid action of every state given the values (tables laid out as (A, S)), ties go to the lowest action id."""
+    return np.argmax(masked_reward + gamma * values[next_state], axis=0)
+
+def oscillation_values(next_state: np.ndarray, masked_reward: np.ndarray, terminal: np.ndarray, gamma: float) -> np.ndarray:
+    """Value of the best way to never move far from each state: stepping into a terminal state, or moving back
+    and forth between the state and one of its neighbours forever. These are values that can actually be achieved,
+    so they are lower bounds of the optimal values.
+    """
+    num_states: int = next_state.shape[0]
+
+    # Reward of stepping back from each successor to the state itself, -inf when that is not possible.
+    returns_home = next_state[next_state] == np.arange(num_states)[:, None, None]
+    back_reward = np.where(returns_home, masked_reward[next_state], -np.inf).max(axis=2)
+
+    oscillate = (masked_reward + gamma * back_reward) / (1.0 - gamma * gamma)
+    values = np.where(terminal[next_state], masked_reward, oscillate).max(axis=1)
+
+    return np.where(terminal, 0.0, values)
+
+def shared_array(shape: tuple[int, ...], dtype: np.dtype, memory: list[shared_memory.SharedMemory]) -> np.ndarray:
+    """Array backed by a new shared memory block. The block is added to memory, so that it can be released later."""
+    block = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1))
+    memory.append(block)
+
+    return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+# Views of the shared tables inside a sweep worker process, set up by attach_tile_worker.
+tile_worker_arrays: dict[str, np.ndarray] = dict()
+tile_worker_memory: list[shared_memory.SharedMemory] = []
+
+def attach_tile_worker(layout: dict[str, tuple[str, tuple[int, ...], str]]) -> None:
+    """Pool initializer: maps the shared blocks (name, shape, dtype) of the tables into the worker process."""
+    for key, (name, shape, dtype) in layout.items():
+        block = shared_memory.SharedMemory(name=name)
+        tile_worker_memory.append(block)
+        tile_worker_arrays[key] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+def sweep_tile(tile: tuple[int, int, int, int, float]) -> None:
+    """Jacobi sweep over the states start:end of one tile: reads values buffer `source`, writes the other buffer.
+    The halo (the rows around the tile) is read from the shared values of the previous sweep, so it is exchanged
+    through shared memory without any copies.
+    """
+    index, start, end, source, gamma = tile
+    values: np.ndarray = tile_worker_arrays["values"][source]
+
+    best_values = np.max(tile_worker_arrays["masked_reward"][:, start:end] + gamma * values[tile_worker_arrays["next_state"][:, start:end]], axis=0)
+    new_values = np.where(tile_worker_arrays["fixed"][start:end], values[start:end], best_values)
+
+    tile_worker_arrays["values"][1 - source, start:end] = new_values
+    tile_worker_arrays["deltas"][index] = np.max(np.abs(new_values - values[start:end]), initial=0.0)
+
+class PrioritizedSweeper:
+    """Asynchronous value iteration on the transition tables: only states whose Bellman error exceeds theta are backed up,
+    largest error first, and a changed state only queues its own predecessors for a re-check.
+    A backup of a single state is a handful of scalar operations, so it runs on plain Python lists instead of arrays.
+    The values array is updated in place.
+    """
+    def __init__(self, model: TransitionModel, mask: np.ndarray, values: np.ndarray, gamma: float, theta: float):
+        self.next_state: np.ndarray = model.next_state
+        self.masked_reward: np.ndarray = masked_rewards(model.reward, mask)
+        self.fixed: np.ndarray = model.terminal | ~mask.any(axis=1)
+        self.values: np.ndarray = values
+        self.gamma: float = gamma
+        self.theta: float = theta
+
+        # List copies of the tables and the values for the backups, the values are written to both.
+        self.next_rows: list[list[int]] = self.next_state.tolist()
+        self.reward_rows: list[list[float]] = self.masked_reward.tolist()
+        self.fixed_list: list[bool] = self.fixed.tolist()
+        self.value_list: list[float] = values.tolist()
+
+        self.indptr, self.predecessors = reverse_transitions(model.next_state, mask)
+        # Predecessors gained through later changes of the tables (see update_states), on top of the index.
+        self.extra_predecessors: dict[int, set[int]] = dict()
+
+        # Priority each state is queued with, 0 when it is not queued. Outdated heap entries are skipped.
+        self.priority: list[float] = [0.0] * len(values)
+        self.queue: list[tuple[float, int]] = []
+
+        # Number of single-state backups computed, including the ones that only check an error.
+        self.num_backups: int = 0
+
+    def predecessors_of(self, s: int) -> list[int]:
+        predecessors: list[int] = self.predecessors[self.indptr[s]:self.indptr[s + 1]].tolist()
+
+        if s in self.extra_predecessors:
+            predecessors.extend(self.extra_predecessors[s])
+
+        return predecessors
+
+    def backup(self, s: int) -> float:
+        self.num_backups += 1
+        values: list[float] = self.value_list
+
+        return max(reward + self.gamma * values[next_s] for reward, next_s in zip(self.reward_rows[s], self.next_rows[s]))
+
+    def set_value(self, s: int, value: float) -> None:
+        self.values[s] = value
+        self.value_list[s] = value
+
+    def push(self, s: int) -> None:
+        if self.fixed_list[s]:
+            return
+
+        error: float = abs(self.backup(s) - self.value_list[s])
+
+        if error > self.theta and error > self.priority[s]:
+            self.priority[s] = error
+            heapq.heappush(self.queue, (-error, s))
+
+    def sweep(self) -> set[int]:
+        """Backs up queued states until none is out of date anymore. Returns the states that were updated."""
+        updated: set[int] = set()
+
+        while self.queue:
+            error, s = heapq.heappop(self.queue)
+            if -error != self.priority[s]:
+                continue
+
+            self.priority[s] = 0.0
+            self.set_value(s, self.backup(s))
+            updated.add(s)
+
+            # Only the predecessors of a changed state can have become out of date.
+            for p in self.predecessors_of(s):
+                self.push(p)
+
+        return updated
+
+    def converge(self) -> None:
+        """Sweeps until no state in the whole grid has a Bellman error above theta. Within a sweep every change re-checks
+        the predecessors of the changed state, so once the queue is empty only states the search never reached can
+        be out of date. The whole grid is only checked for those after a sweep.
+        """
+        while True:
+            self.sweep()
+
+            # States not connected to the queued ones are never reached by the search, so check the whole grid once more.
+            out_of_date: np.ndarray = self.out_of_date()
+
+            if len(out_of_date) == 0:
+                break
+
+            for s in out_of_date.tolist():
+                self.push(s)
+
+    def out_of_date(self) -> np.ndarray:
+        """The states of the whole grid with a Bellman error above theta."""
+        errors = np.abs(bellman_backup(self.values, self.next_state.T, self.masked_reward.T, self.fixed, self.gamma) - self.values)
+
+        return np.flatnonzero(errors > self.theta)
+
+    def update_states(self, model: TransitionModel, states: list[int]) -> None:
+        """Takes over the changed rows of the transition tables for the given states and queues them."""
+        self.next_state = model.next_state
+
+        for s in states:
+            mask: np.ndarray = model.next_state[s] != s
+            self.masked_reward[s] = np.where(mask, model.reward[s], -np.inf)
+            self.fixed[s] = model.terminal[s] or not mask.any()
+
+            self.next_rows[s] = model.next_state[s].tolist()
+            self.reward_rows[s] = self.masked_reward[s].tolist()
+            self.fixed_list[s] = bool(self.fixed[s])
+
+            if model.terminal[s]:
+                self.set_value(s, 0.0)
+
+            for next_s in model.next_state[s][mask].tolist():
+                self.extra_predecessors.setdefault(next_s, set()).add(s)
+
+        for s in states:
+            self.push(s)
+            for p in self.predecessors_of(s):
+                self.push(p)
+
+    def greedy_action(self, s: int) -> int:
+        return int(np.argmax(self.masked_reward[s] + self.gamma * self.values[self.next_state[s]]))
 
 class ValueIterationAlgorithm(Algorithm):
-    def __init__(self, policy: dict[tuple[int, int], dict[tuple[int, int], float]], grid_action_cb: Callable[[tuple[int, int], tuple[int, int]], Observation], 
-                 grid_pos: tuple[int, int], grid_size: int):
-        super().__init__(policy, grid_action_cb, grid_pos, grid_size)
+    def __init__(self, policy: dict[int, dict[int, float]], grid_action_cb: Callable[[int, int], Observation], 
+                 state: int, grid_size: int, model_cb: Callable[[], TransitionModel] = None, rng: np.random.Generator = None):
+        super().__init__(policy, grid_action_cb, state, grid_size, model_cb, rng)
 
-        self.potential_rewards: dict[tuple[int, int], float] = dict()
-        self.optimal_actions: dict[tuple[int, int], tuple[int, int]] = dict()
+        self.potential_rewards: dict[int, float] = dict()
+        self.optimal_actions: dict[int, int] = dict()
+
+        # The solution of the last run, kept so that it can be repaired by replan.
+        self.values: np.ndarray = None
+        self.gamma_factor: float = None
+        self.theta_factor: float = None
+        self.sweeper: PrioritizedSweeper = None
+        # Number of single-state backups the last run computed (a synchronous sweep backs up every state once).
+        self.num_backups: int = 0
 
     def terminate(self):
         return super().terminate()
 
-    def run(self, gamma_factor: float = 0.8, theta_factor: float = 0.001):
+    def run(self, gamma_factor: float = 0.8, theta_factor: float = 0.001, backend: str = "python", num_workers: int = None):
+        """Runs value iteration. The backend is either "python" (in-place sweeps through grid_action_cb),
+        "numpy" (synchronous sweeps over the whole grid as array operations on the transition tables),
+        "prioritized" (asynchronous backups of only the states whose values are out of date, largest Bellman error first)
+        or "parallel" (the sweeps of "numpy", split into bands of rows that num_workers processes sweep at once).
+        """
         self.potential_rewards.clear() # A dictionary of the potential rewards for each Cell.
-        self.optimal_actions.clear() # The best actions for each given Cell
+        self.optimal_actions.clear() # The best actions for each given (non-terminal) Cell
+
+        self.gamma_factor = gamma_factor
+        self.theta_factor = theta_factor
+        self.sweeper = None
+        self.num_backups = 0
+
+        match backend:
+            case "python":
+                self.run_python(gamma_factor, theta_factor)
+            case "numpy":
+                self.run_numpy(gamma_factor, theta_factor)
+            case "prioritized":
+                self.run_prioritized(gamma_factor, theta_factor)
+            case "parallel":
+                self.run_parallel(gamma_factor, theta_factor, num_workers)
+            case _:
+                raise ValueError("Unknown value iteration backend '{}'".format(backend))
 
-        for x in range(self.grid_size):
-            for y in range(self.grid_size):
-                self.potential_rewards[(x,y)] = 0
-                self.optimal_actions[(x,y)] = (0, 0)
+        for state in self.optimal_actions:
+            self.policy[state].clear()
+            self.policy[state][self.optimal_actions[state]] = 1.0
+
+    def run_python(self, gamma_factor: float, theta_factor: float):
+        for s in range(self.grid_size * self.grid_size):
+            self.potential_rewards[s] = 0
 
         # Make delta higher than theta to start while loop.
         delta: float = theta_factor + 1.0
@@ -31,36 +264,185 @@ class ValueIterationAlgorithm(Algorithm):
             delta = 0
 
             # Iterate over each Cell in the grid (s).
-            for x in range(self.grid_size):
-                for y in range(self.grid_size):
-                    curr_state: Observation = self.grid_action_cb((x,y))
-
-                    # Skip terminal cells.
-                    if curr_state.is_terminal:
-                        continue
-
-                    s: tuple[int, int] = (x,y)
-
-                    # Get old value
-                    v = self.potential_rewards[s]
-
-                    actions = {}
-                    # Iterate over each action to find the value for each action.
-                    for action in self.policy[s]:
-                        # Create the new position given an action and the current position.
-                        next_state = self.grid_action_cb(s, action)
-                        # Calculate the potential reward for an action.
-                        actions[action] = next_state.reward + gamma_factor * self.potential_rewards[next_state.grid_pos]
-
-                    # Get the action with the highest value.
-                    best_action, best_value = max(actions.items(), key=operator.itemgetter(1))
-                    # Update the best actions policy dictionary.
-                    self.optimal_actions[s] = best_action
-                    # Update the potential reward for this cell.
-                    self.potential_rewards[s] = best_value
-                    # Update delta to the difference of the old value and the new value, if larger than delta.
-                    delta = max(delta, abs(v - best_value))
-
-        for position in self.optimal_actions:
-            self.policy[position].clear()
-            self.policy[position][self.optimal_actions[position]] = 1.0
\ No newline at end of file
+            for s in range(self.grid_size * self.grid_size):
+                curr_state: Observation = self.grid_action_cb(s)
+
+                # Skip terminal cells.
+                if curr_state.is_terminal:
+                    continue
+
+                self.num_backups += 1
+
+                # Get old value
+                v = self.potential_rewards[s]
+
+                actions = {}
+                # Iterate over each action to find the value for each action.
+                for action in self.policy[s]:
+                    # Get the new state given an action and the current state.
+                    next_state = self.grid_action_cb(s, action)
+                    # Calculate the potential reward for an action.
+                    actions[action] = next_state.reward + gamma_factor * self.potential_rewards[next_state.state]
+
+                # Get the action with the highest value.
+                best_action, best_value = max(actions.items(), key=operator.itemgetter(1))
+                # Update the best actions policy dictionary.
+                self.optimal_actions[s] = best_action
+                # Update the potential reward for this cell.
+                self.potential_rewards[s] = best_value
+                # Update delta to the difference of the old value and the new value, if larger than delta.
+                delta = max(delta, abs(v - best_value))
+
+        self.values = np.array([self.potential_rewards[s] for s in range(self.grid_size * self.grid_size)], dtype=float)
+
+    def run_numpy(self, gamma_factor: float, theta_factor: float):
+        model: TransitionModel = self.transition_model()
+        num_states: int = self.grid_size * self.grid_size
+
+        # Only the actions in the policy are considered, like the python backend does.
+        mask: np.ndarray = policy_action_mask(self.policy, num_states)
+        fixed: np.ndarray = model.terminal | ~mask.any(axis=1)
+
+        # Action-major copies of the tables for the backups.
+        next_state: np.ndarray = np.ascontiguousarray(model.next_state.T)
+        masked_reward: np.ndarray = np.ascontiguousarray(masked_rewards(model.reward, mask).T)
+
+        values = np.zeros(num_states)
+
+        # Make delta higher than theta to start while loop.
+        delta: float = theta_factor + 1.0
+        while delta > theta_factor:
+            new_values = bellman_backup(values, next_state, masked_reward, fixed, gamma_factor)
+            self.num_backups += num_states
+            delta = float(np.max(np.abs(new_values - values)))
+            values = new_values
+
+        # The optimal actions follow the values of the last sweep, like in the python backend.
+        best_actions = greedy_actions(values, next_state, masked_reward, gamma_factor)
+        self.values = values
+
+        self.potential_rewards.update(enumerate(values.tolist()))
+        self.optimal_actions.update(zip(np.flatnonzero(~fixed).tolist(), best_actions[~fixed].tolist()))
+
+    def run_parallel(self, gamma_factor: float, theta_factor: float, num_workers: int = None):
+        model: TransitionModel = self.transition_model()
+        num_states: int = self.grid_size * self.grid_size
+        num_workers = num_workers or os.cpu_count() or 1
+
+        # The same tables as the numpy backend, so that both give the same values.
+        mask: np.ndarray = policy_action_mask(self.policy, num_states)
+        fixed: np.ndarray = model.terminal | ~mask.any(axis=1)
+        next_state: np.ndarray = model.next_state.T
+        masked_reward: np.ndarray = masked_rewards(model.reward, mask).T
+
+        # Each tile is a band of whole rows, so its halo is just the row above and the row below it.
+        num_tiles: int = max(1, min(num_workers, self.grid_size))
+        bounds: list[int] = (np.linspace(0, self.grid_size, num_tiles + 1).astype(int) * self.grid_size).tolist()
+
+        memory: list[shared_memory.SharedMemory] = []
+        try:
+            # The tables, two value buffers (read one, write the other) and the delta of every tile live in shared memory.
+            arrays: dict[str, np.ndarray] = {
+                "next_state": shared_array(next_state.shape, next_state.dtype, memory),
+                "masked_reward": shared_array(masked_reward.shape, masked_reward.dtype, memory),
+                "fixed": shared_array(fixed.shape, fixed.dtype, memory),
+                "values": shared_array((2, num_states), np.float64, memory),
+                "deltas": shared_array((num_tiles,), np.float64, memory),
+            }
+            arrays["next_state"][:] = next_state
+            arrays["masked_reward"][:] = masked_reward
+            arrays["fixed"][:] = fixed
+            arrays["values"][:] = 0.0
+
+            layout = {key: (block.name, array.shape, array.dtype.str) for (key, array), block in zip(arrays.items(), memory)}
+
+            with multiprocessing.Pool(num_workers, initializer=attach_tile_worker, initargs=(layout,)) as pool:
+                source: int = 0
+
+                # Make delta higher than theta to start while loop.
+                delta: float = theta_factor + 1.0
+                while delta > theta_factor:
+                    pool.map(sweep_tile, [(i, bounds[i], bounds[i + 1], source, gamma_factor) for i in range(num_tiles)])
+                    self.num_backups += num_states
+
+                    delta = float(arrays["deltas"].max())
+                    source = 1 - source
+
+            values: np.ndarray = arrays["values"][source].copy()
+        finally:
+            # The views have to be gone before the blocks can be closed.
+            arrays = None
+            for block in memory:
+                block.close()
+                block.unlink()
+
+        best_actions = greedy_actions(values, next_state, masked_reward, gamma_factor)
+        self.values = values
+
+        self.potential_rewards.update(enumerate(values.tolist()))
+        self.optimal_actions.update(zip(np.flatnonzero(~fixed).tolist(), best_actions[~fixed].tolist()))
+
+    def run_prioritized(self, gamma_factor: float, theta_factor: float):
+        model: TransitionModel = self.transition_model()
+        num_states: int = self.grid_size * self.grid_size
+        mask: np.ndarray = policy_action_mask(self.policy, num_states)
+
+        # Start from the best value of staying close to each state (stepping into a terminal state or moving back and
+        # forth forever, see oscillation_values). Away from the terminal states and the special cells that is already
+        # the fixed point, and around a rewarding cell it is the value of circling it, which sweeps would otherwise
+        # only approach in many small steps when gamma is close to 1.
+        self.values = np.zeros(num_states)
+        if gamma_factor < 1.0 and mask.any():
+            fixed: np.ndarray = model.terminal | ~mask.any(axis=1)
+            lower_bound: float = min(float(model.reward[mask].min()), 0.0) / (1.0 - gamma_factor)
+            oscillation = oscillation_values(model.next_state, masked_rewards(model.reward.astype(float), mask), model.terminal, gamma_factor)
+            self.values[~fixed] = np.maximum(oscillation, lower_bound)[~fixed]
+
+        self.sweeper = PrioritizedSweeper(model, mask, self.values, gamma_factor, theta_factor)
+
+        # Values change first around the terminal states, so the search starts from their predecessors.
+        for t in np.flatnonzero(model.terminal):
+            for s in self.sweeper.predecessors_of(int(t)):
+                self.sweeper.push(s)
+
+        self.sweeper.converge()
+        self.num_backups = self.sweeper.num_backups
+
+        fixed: np.ndarray = self.sweeper.fixed
+        best_actions = greedy_actions(self.values, model.next_state.T, self.sweeper.masked_reward.T, gamma_factor)
+
+        self.potential_rewards.update(enumerate(self.values.tolist()))
+        self.optimal_actions.update(zip(np.flatnonzero(~fixed).tolist(), best_actions[~fixed].tolist()))
+
+    def replan(self, changed_states: list[int]) -> list[int]:
+        """Repairs the solution of the last run after the transitions of the given states changed, e.g. the states
+        returned by SchoolEnv.update_cell. Changes are propagated from those states only, with prioritized sweeping.
+        Returns the states whose policy was updated.
+        """
+        if self.values is None:
+            raise RuntimeError("Value iteration has to run before it can replan")
+
+        model: TransitionModel = self.transition_model()
+
+        if self.sweeper is None:
+            self.sweeper = PrioritizedSweeper(model, valid_action_mask(model), self.values, self.gamma_factor, self.theta_factor)
+
+        self.sweeper.update_states(model, changed_states)
+        updated: set[int] = self.sweeper.sweep()
+
+        # The best action of a state can change when the value of one of its successors changed.
+        touched: set[int] = updated.union(changed_states)
+        for s in list(touched):
+            touched.update(self.sweeper.predecessors_of(s))
+
+        for s in touched:
+            self.potential_rewards[s] = float(self.values[s])
+
+            if self.sweeper.fixed[s]:
+                self.optimal_actions.pop(s, None)
+                continue
+
+            self.optimal_actions[s] = self.sweeper.greedy_action(s)
+            self.policy[s] = {self.optimal_actions[s]: 1.0}
+
+        return sorted(touched)
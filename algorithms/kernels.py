@@ -0,0 +1,285 @@
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+from algorithms.policy import Policy
+from algorithms.utils import EpisodeBuffer, TransitionModel, UniformStream, policy_matrix
+
+# Whether the kernels are compiled, without Numba the same kernels run as plain Python.
+JIT_AVAILABLE: bool = numba is not None
+
+# How a kernel call ended. A paused kernel ran out of uniforms (or buffer space) and is called again to continue
+# the episode where it stopped.
+PAUSED: int = 0
+TERMINAL: int = 1
+TRUNCATED: int = 2
+NO_ACTION: int = 3
+
+# Uniforms handed to a kernel per call, it pauses when it may need more than it has left.
+KERNEL_UNIFORMS: int = 1024
+
+def jit(function):
+    """Compiles a kernel with Numba when it is installed, otherwise the kernel is returned as is."""
+    if numba is None:
+        return function
+
+    return numba.njit(cache=True)(function)
+
+@jit
+def sample_action(cumulative: np.ndarray, state: int, uniform: float) -> int:
+    """The action of the state at the uniform sample, from the cumulative policy (like Policy.sample), -1 if the
+    state has no action with a positive probability.
+    """
+    total = cumulative[state, -1]
+    if total <= 0.0:
+        return -1
+
+    return min(int(np.searchsorted(cumulative[state], uniform * total, side="right")), cumulative.shape[1] - 1)
+
+@jit
+def q_learning_kernel(q_table: np.ndarray, next_state: np.ndarray, reward: np.ndarray, terminal: np.ndarray,
+                      cumulative: np.ndarray, alpha: float, gamma: float, epsilon: float, max_steps: int,
+                      uniforms: np.ndarray, visits: np.ndarray, visited: np.ndarray,
+                      state: int, num_steps: int, total_reward: float):
+    """Steps of a Q-learning episode, the same as the loop of QLearningAlgorithm.run without traces.
+    Returns the state, number of steps and total reward so far, the number of uniforms used and the status.
+    """
+    used = 0
+
+    while True:
+        if terminal[state]:
+            return state, num_steps, total_reward, used, TERMINAL
+
+        if num_steps == max_steps:
+            return state, num_steps, total_reward, used, TRUNCATED
+
+        # A step takes at most two uniforms.
+        if used + 2 > len(uniforms):
+            return state, num_steps, total_reward, used, PAUSED
+
+        num_steps += 1
+
+        if not visited[state]:
+            visited[state] = True
+            visits[state] += 1
+
+        # Epsilon-greedy action, ties go to the lowest action id.
+        used += 1
+        if uniforms[used - 1] < epsilon:
+            action = sample_action(cumulative, state, uniforms[used])
+            used += 1
+
+            if action < 0:
+                return state, num_steps, total_reward, used, NO_ACTION
+        else:
+            action = np.argmax(q_table[state])
+
+        s = next_state[state, action]
+        r = float(reward[state, action])
+        total_reward += r
+
+        target = r
+        if not terminal[s]:
+            target += gamma * np.max(q_table[s])
+
+        q_table[state, action] += alpha * (target - q_table[state, action])
+        state = s
+
+@jit
+def sarsa_action(values: np.ndarray, action_mask: np.ndarray, neighbour_states: np.ndarray, neighbour_rewards: np.ndarray,
+                 terminal_action: np.ndarray, cumulative: np.ndarray, state: int, gamma: float, epsilon: float,
+                 uniforms: np.ndarray, used: int):
+    """The epsilon-greedy action of TDSarsaAlgorithm.epsilon_greedy, returns it with the number of uniforms used."""
+    used += 1
+    if uniforms[used - 1] < epsilon:
+        return sample_action(cumulative, state, uniforms[used]), used + 1
+
+    if terminal_action[state] >= 0:
+        return terminal_action[state], used
+
+    # A random one of the actions with the highest reward plus discounted value of their neighbour.
+    num_actions = action_mask.shape[1]
+    evaluations = np.full(num_actions, -np.inf)
+    for a in range(num_actions):
+        if action_mask[state, a]:
+            evaluations[a] = neighbour_rewards[state, a] + gamma * values[neighbour_states[state, a]]
+
+    best = np.max(evaluations)
+    num_best = 0
+    for a in range(num_actions):
+        if evaluations[a] == best:
+            num_best += 1
+
+    choice = min(int(uniforms[used] * num_best), num_best - 1)
+    for a in range(num_actions):
+        if evaluations[a] == best:
+            if choice == 0:
+                return a, used + 1
+            choice -= 1
+
+    return -1, used + 1
+
+@jit
+def sarsa_kernel(values: np.ndarray, action_mask: np.ndarray, neighbour_states: np.ndarray, neighbour_rewards: np.ndarray,
+                 neighbour_terminal: np.ndarray, terminal_action: np.ndarray, cumulative: np.ndarray,
+                 alpha: float, gamma: float, epsilon: float, max_steps: int, uniforms: np.ndarray,
+                 visits: np.ndarray, visited: np.ndarray, state: int, action: int, num_steps: int, total_reward: float):
+    """Steps of a SARSA episode, the same as the loop of TDSarsaAlgorithm.run without traces. An action of -1 starts
+    the episode. Returns the state, action, number of steps and total reward so far, the number of uniforms used
+    and the status.
+    """
+    used = 0
+
+    if action < 0:
+        action, used = sarsa_action(values, action_mask, neighbour_states, neighbour_rewards, terminal_action, cumulative, state, gamma,
+                                    epsilon, uniforms, used)
+
+    while True:
+        if action < 0:
+            return state, action, num_steps, total_reward, used, NO_ACTION
+
+        # A step takes at most two uniforms.
+        if used + 2 > len(uniforms):
+            return state, action, num_steps, total_reward, used, PAUSED
+
+        num_steps += 1
+
+        if not visited[state]:
+            visited[state] = True
+            visits[state] += 1
+
+        s = neighbour_states[state, action]
+        r = neighbour_rewards[state, action]
+        is_terminal = neighbour_terminal[state, action]
+
+        next_action, used = sarsa_action(values, action_mask, neighbour_states, neighbour_rewards, terminal_action, cumulative, s, gamma,
+                                         epsilon, uniforms, used)
+
+        delta = r + gamma * values[s] - values[state]
+        values[state] += alpha * delta
+
+        state = s
+        action = next_action
+        total_reward += r
+
+        if is_terminal:
+            return state, action, num_steps, total_reward, used, TERMINAL
+
+        if num_steps == max_steps:
+            return state, action, num_steps, total_reward, used, TRUNCATED
+
+@jit
+def policy_episode_kernel(cumulative: np.ndarray, next_state: np.ndarray, reward: np.ndarray, terminal: np.ndarray,
+                          max_steps: int, uniforms: np.ndarray, states: np.ndarray, actions: np.ndarray,
+                          rewards: np.ndarray, state: int, length: int):
+    """Steps of an episode that follows the policy, the same as generate_episode_buffer, recorded into the arrays.
+    Returns the state and episode length so far, the number of uniforms used and the status.
+    """
+    used = 0
+
+    while True:
+        if used == len(uniforms) or length == len(states):
+            return state, length, used, PAUSED
+
+        action = sample_action(cumulative, state, uniforms[used])
+        used += 1
+
+        if action < 0:
+            return state, length, used, NO_ACTION
+
+        states[length] = state
+        actions[length] = action
+        rewards[length] = reward[state, action]
+        length += 1
+
+        state = next_state[state, action]
+
+        if terminal[state]:
+            return state, length, used, TERMINAL
+
+        if length == max_steps:
+            return state, length, used, TRUNCATED
+
+def policy_cumulative(policy: dict[int, dict[int, float]], num_states: int) -> np.ndarray:
+    """The cumulative action probabilities of every state, shape (S, A), as used by the kernels."""
+    if isinstance(policy, Policy):
+        policy.refresh()
+        return policy.cumulative
+
+    return np.cumsum(policy_matrix(policy, num_states), axis=1)
+
+def kernel_max_steps(max_steps: int) -> int:
+    # Kernels take plain integers, -1 is never reached.
+    return -1 if max_steps is None else max_steps
+
+def run_q_learning_episode(q_table: np.ndarray, model: TransitionModel, cumulative: np.ndarray, state: int, alpha: float,
+                           gamma: float, epsilon: float, max_steps: int, uniforms: UniformStream,
+                           visits: np.ndarray, visited: np.ndarray) -> tuple[float, int, bool]:
+    """Runs a Q-learning episode with q_learning_kernel. Returns the total reward, the number of steps and whether
+    the episode was truncated.
+    """
+    num_steps: int = 0
+    total_reward: float = 0.0
+    visited.fill(False)
+
+    status: int = PAUSED
+    while status == PAUSED:
+        state, num_steps, total_reward, used, status = q_learning_kernel(
+            q_table, model.next_state, model.reward, model.terminal, cumulative, alpha, gamma, epsilon,
+            kernel_max_steps(max_steps), uniforms.upcoming(KERNEL_UNIFORMS), visits, visited, state, num_steps, total_reward)
+        uniforms.skip(used)
+
+    if status == NO_ACTION:
+        raise ValueError("The policy of state {} has no action with a positive probability".format(state))
+
+    return float(total_reward), int(num_steps), status == TRUNCATED
+
+def run_sarsa_episode(values: np.ndarray, action_mask: np.ndarray, neighbour_states: np.ndarray, neighbour_rewards: np.ndarray,
+                      neighbour_terminal: np.ndarray, terminal_action: np.ndarray, cumulative: np.ndarray, state: int,
+                      alpha: float, gamma: float, epsilon: float, max_steps: int, uniforms: UniformStream,
+                      visits: np.ndarray, visited: np.ndarray) -> tuple[float, int, bool]:
+    """Runs a SARSA episode with sarsa_kernel. Returns the total reward, the number of steps and whether the episode
+    was truncated.
+    """
+    action: int = -1
+    num_steps: int = 0
+    total_reward: float = 0.0
+    visited.fill(False)
+
+    status: int = PAUSED
+    while status == PAUSED:
+        state, action, num_steps, total_reward, used, status = sarsa_kernel(
+            values, action_mask, neighbour_states, neighbour_rewards, neighbour_terminal, terminal_action, cumulative,
+            alpha, gamma, epsilon, kernel_max_steps(max_steps), uniforms.upcoming(KERNEL_UNIFORMS), visits, visited,
+            state, action, num_steps, total_reward)
+        uniforms.skip(used)
+
+    if status == NO_ACTION:
+        raise ValueError("The policy of state {} has no action with a positive probability".format(state))
+
+    return float(total_reward), int(num_steps), status == TRUNCATED
+
+def run_policy_episode(cumulative: np.ndarray, model: TransitionModel, state: int, buffer: EpisodeBuffer,
+                       max_steps: int = None, uniforms: UniformStream = None) -> EpisodeBuffer:
+    """Like generate_episode_buffer, but runs the episode with policy_episode_kernel on the transition tables."""
+    buffer.clear()
+
+    status: int = PAUSED
+    while status == PAUSED:
+        if buffer.length == len(buffer.states):
+            buffer.grow()
+
+        state, buffer.length, used, status = policy_episode_kernel(
+            cumulative, model.next_state, model.reward, model.terminal, kernel_max_steps(max_steps),
+            uniforms.upcoming(KERNEL_UNIFORMS), buffer.states, buffer.actions, buffer.rewards, state, buffer.length)
+        uniforms.skip(used)
+
+    if status == NO_ACTION:
+        raise ValueError("The policy of state {} has no action with a positive probability".format(state))
+
+    buffer.is_truncated = status == TRUNCATED
+
+    return buffer
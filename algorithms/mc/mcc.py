@@ -1,85 +1,259 @@
+import bisect
+import multiprocessing
 from typing import Callable
 import numpy as np
 
 from algorithms.algorithm import Algorithm
-from algorithms.utils import Observation, generate_episode
+from algorithms.kernels import policy_cumulative, run_policy_episode
+from algorithms.utils import ConvergenceMonitor, EpisodeBuffer, Observation, TransitionModel, generate_episode_buffer, policy_matrix
+from math_utils import ACTIONS
+
+# The transition tables as lists inside an episode worker process, set up by attach_episode_worker.
+episode_worker_model: dict[str, list] = dict()
+
+def attach_episode_worker(model: TransitionModel) -> None:
+    """Pool initializer: the tables are sent to every worker once, instead of with every batch."""
+    episode_worker_model["next_state"] = model.next_state.tolist()
+    episode_worker_model["reward"] = model.reward.tolist()
+    episode_worker_model["terminal"] = model.terminal.tolist()
+
+def generate_episode_chunk(task: tuple[np.ndarray, int, int, int, np.random.SeedSequence]) -> tuple[np.ndarray, ...]:
+    """Generates a number of episodes from the start state, sampling actions from the cumulative policy with the
+    task's own random stream. Returns the concatenated states, actions and rewards, with the length of every episode
+    and whether it was truncated.
+    """
+    cumulative, state, num_episodes, max_steps, seed = task
+    cumulative = cumulative.tolist()
+    next_state, reward, terminal = episode_worker_model["next_state"], episode_worker_model["reward"], episode_worker_model["terminal"]
+
+    rng = np.random.default_rng(seed)
+    uniforms: list[float] = []
+
+    states: list[int] = []
+    actions: list[int] = []
+    rewards: list[float] = []
+    lengths: list[int] = []
+    truncated: list[bool] = []
+
+    for _ in range(num_episodes):
+        s: int = state
+        length: int = 0
+
+        while (True):
+            # Uniforms are drawn in blocks, drawing them one at a time costs more than the rest of a step.
+            if not uniforms:
+                uniforms = rng.random(1024).tolist()
+
+            row: list[float] = cumulative[s]
+            act: int = min(bisect.bisect_right(row, uniforms.pop() * row[-1]), len(row) - 1)
+
+            states.append(s)
+            actions.append(act)
+            rewards.append(reward[s][act])
+            length += 1
+
+            s = next_state[s][act]
+
+            if (terminal[s] or length == max_steps):
+                break
+
+        lengths.append(length)
+        truncated.append(not terminal[s])
+
+    return (np.array(states, dtype=np.int64), np.array(actions, dtype=np.int64), np.array(rewards),
+            np.array(lengths, dtype=np.int64), np.array(truncated, dtype=bool))
 
 class MonteCarloAlgorithm(Algorithm):
-    def __init__(self, policy: dict[tuple[int, int], dict[tuple[int, int], float]], grid_action_cb: Callable[[tuple[int, int], tuple[int, int]], Observation], 
-                 grid_pos: tuple[int, int], grid_size: int):
-        super().__init__(policy, grid_action_cb, grid_pos, grid_size)
+    def __init__(self, policy: dict[int, dict[int, float]], grid_action_cb: Callable[[int, int], Observation], 
+                 state: int, grid_size: int, model_cb: Callable[[], TransitionModel] = None, rng: np.random.Generator = None):
+        super().__init__(policy, grid_action_cb, state, grid_size, model_cb, rng)
 
         self.total_rewards: list[float] = list()
-        self.total_state_visits: dict[tuple[int, int], int] = dict()
-        self.total_state_visits_tracker: dict[tuple[int, int], bool] = dict()
+        self.total_state_visits: dict[int, int] = dict()
+        # Number of episodes cut off at the step limit.
+        self.num_truncated: int = 0
+        # Number of episodes run when the run stopped early on convergence, None when all episodes ran.
+        self.stopped_episode: int = None
+
+        # Estimates of the state-action values, shape (S, A), see run.
+        self.action_values: np.ndarray = None
+        self.action_counts: np.ndarray = None
+        self.first_estimate: np.ndarray = None
+        self.num_estimated: int = 0
+        self.state_visits: np.ndarray = None
     
-    def run(self, gamma_factor: float = 0.95, num_episodes: int = 200, epsilon_mod: float = 0.25):
+    def run(self, gamma_factor: float = 0.95, num_episodes: int = 200, epsilon_mod: float = 0.25, step_size: float = None,
+            visits: str = "first", max_steps: int = None, num_workers: int = None, batch_size: int = 100, seed: int = None,
+            patience: int = None, tolerance: float = None, window: int = 10, backend: str = "python"):
         """ Estimates the value of each state-action pair based on the current policy.
-        Updates the policy accordingly, taking into account the epsilon factor
+        Updates the policy accordingly, taking into account the epsilon factor.
+        The estimates are running means of the returns, or with a constant step_size an exponentially weighted mean
+        that keeps tracking the returns on a changing map. Memory does not grow with the number of episodes.
+        With visits "first" only the return of the first visit of a pair in an episode counts, with "every" all of them.
+        Episodes are cut off after max_steps steps, their returns then only cover the steps that were taken.
+        With num_workers, batches of batch_size episodes are generated by a pool of processes (see run_parallel).
+        A seed restarts the algorithm's random generator, for reproducible runs.
+        With patience or tolerance the run stops early once it converged, see ConvergenceMonitor. In parallel runs
+        this is checked once per batch.
+        The backend "jit" generates the episodes with a kernel on the transition tables instead of through
+        grid_action_cb, see algorithms.kernels.
+        """
+        if visits not in ("first", "every"):
+            raise ValueError("Unknown Monte Carlo visits '{}'".format(visits))
+
+        if backend not in ("python", "jit"):
+            raise ValueError("Unknown Monte Carlo backend '{}'".format(backend))
+
+        if backend == "jit" and num_workers is not None:
+            raise ValueError("The jit backend does not run with workers")
+
+        self.seed(seed)
+
+        num_states: int = self.grid_size * self.grid_size
+        self.num_truncated = 0
+        self.stopped_episode = None
+
+        monitor = ConvergenceMonitor(patience, tolerance, window) if patience is not None or tolerance is not None else None
+
+        # Running estimate and number of returns of each state-action pair.
+        self.action_values = np.zeros((num_states, len(ACTIONS)))
+        self.action_counts = np.zeros((num_states, len(ACTIONS)), dtype=np.int64)
+
+        # Order in which the pairs got their first estimate, ties between equal estimates go to the earliest one.
+        self.first_estimate = np.full((num_states, len(ACTIONS)), np.iinfo(np.int64).max)
+        self.num_estimated = 0
+
+        self.state_visits = np.zeros(num_states, dtype=np.int64)
+
+        if num_workers is not None:
+            self.run_parallel(gamma_factor, num_episodes, epsilon_mod, step_size, visits, max_steps, num_workers, batch_size, monitor)
+        else:
+            episode: EpisodeBuffer = EpisodeBuffer()
+            model: TransitionModel = self.transition_model() if backend == "jit" else None
+
+            # Traverse a number of episodes
+            for n in range(num_episodes):
+                # The epsilon factor (or exploration factor) determines how eager the algorithm is to randomly choose an unoptimal path
+                # As the algorithm starts to converge, the algorithm should focus more on exploitation, thus the epsilon factor get smaller
+                # The decline of the epsilon factor can be adjusted with "epsilon_mod"
+                epsilon_factor: float = 1.0 / (n * epsilon_mod + 1)
+
+                if backend == "jit":
+                    run_policy_episode(policy_cumulative(self.policy, num_states), model, self.state, episode, max_steps, self.uniforms)
+                else:
+                    generate_episode_buffer(self.policy, self.grid_action_cb, self.state, episode, max_steps, self.uniforms)
+
+                self.improve_policy(self.record_episode(episode, gamma_factor, step_size, visits), epsilon_factor)
+
+                if monitor is not None and monitor.update(self.greedy_actions, self.action_values):
+                    self.stopped_episode = n + 1
+                    break
+
+        self.total_state_visits.update(enumerate(self.state_visits.tolist()))
+
+    def run_parallel(self, gamma_factor: float, num_episodes: int, epsilon_mod: float, step_size: float, visits: str,
+                     max_steps: int, num_workers: int, batch_size: int, monitor: ConvergenceMonitor = None):
+        """Generates the episodes in batches: every worker generates its share of a batch with the current policy,
+        the episodes are then recorded in order and the policy is improved once per batch.
+        Every share of a batch has its own random stream spawned from the algorithm's generator, so that a run is
+        reproducible for a given seed, number of workers and batch size.
         """
+        model: TransitionModel = self.transition_model()
+        seed_sequence = np.random.SeedSequence(int(self.rng.integers(2**63)))
+        episode: EpisodeBuffer = EpisodeBuffer()
+
+        with multiprocessing.Pool(num_workers, initializer=attach_episode_worker, initargs=(model,)) as pool:
+            for first in range(0, num_episodes, batch_size):
+                num_batch: int = min(batch_size, num_episodes - first)
+
+                # The policy as cumulative probabilities per state, for sampling by bisection.
+                cumulative = np.cumsum(policy_matrix(self.policy, self.grid_size * self.grid_size), axis=1)
+                shares = [int(len(share)) for share in np.array_split(np.arange(num_batch), num_workers)]
+
+                tasks = [(cumulative, self.state, share, max_steps, stream)
+                         for share, stream in zip(shares, seed_sequence.spawn(num_workers)) if share > 0]
+
+                visited: list[np.ndarray] = []
+                for states, actions, rewards, lengths, truncated in pool.map(generate_episode_chunk, tasks):
+                    for start, end, is_truncated in zip(np.cumsum(lengths) - lengths, np.cumsum(lengths), truncated):
+                        episode.clear()
+                        episode.extend(states[start:end], actions[start:end], rewards[start:end])
+                        episode.is_truncated = bool(is_truncated)
+
+                        visited.append(self.record_episode(episode, gamma_factor, step_size, visits))
+
+                # The epsilon factor of the last episode of the batch, like the sequential run would use.
+                epsilon_factor: float = 1.0 / ((first + num_batch - 1) * epsilon_mod + 1)
+                self.improve_policy(np.unique(np.concatenate(visited)), epsilon_factor)
+
+                if monitor is not None and monitor.update(self.greedy_actions, self.action_values, num_batch):
+                    self.stopped_episode = first + num_batch
+                    break
+
+    def record_episode(self, episode: EpisodeBuffer, gamma_factor: float, step_size: float, visits: str) -> np.ndarray:
+        """Adds the returns of an episode to the estimates. Returns the states whose estimates changed."""
+        self.num_truncated += episode.is_truncated
+        self.total_rewards.append(float(episode.rewards[:len(episode)].sum()))
 
-        state_action_returns: dict[tuple[int, int], dict[tuple[int, int], list[float]]] = dict()
-        state_action_vals: dict[tuple[int, int], dict[tuple[int, int], float]] = dict()
+        returns: np.ndarray = episode.returns(gamma_factor)
+        states: np.ndarray = episode.states[:len(episode)]
+        actions: np.ndarray = episode.actions[:len(episode)]
 
-        for x in range(self.grid_size):
-            for y in range(self.grid_size):
-                state_action_returns[(x, y)] = dict()
-                state_action_vals[(x, y)] = dict()
-                self.total_state_visits[(x, y)] = 0
+        self.state_visits[np.unique(states)] += 1
 
-        episode: list[tuple[tuple[int, int], int]] = list()
-        visited_state_actions: list[tuple[int, int, int, int]] = list()
+        # Only add the return values of the first visits of the state-action pairs (or of all visits)
+        if visits == "first":
+            first: np.ndarray = episode.first_visits()
+            states, actions, returns = states[first], actions[first], returns[first]
 
-        reward: float = 0.0
+        pairs, inverse, counts = np.unique(states * len(ACTIONS) + actions, return_inverse=True, return_counts=True)
+        pair_states, pair_actions = np.divmod(pairs, len(ACTIONS))
 
-        # Traverse a number of episodes
-        for n in range(num_episodes):
-            # Reset all relevant variables for a new episode
-            visited_state_actions.clear()
+        # Pairs estimated for the first time are ordered by their first visit.
+        new_pairs: np.ndarray = self.action_counts[pair_states, pair_actions] == 0
+        self.first_estimate[pair_states[new_pairs], pair_actions[new_pairs]] = self.num_estimated + np.arange(np.count_nonzero(new_pairs))
+        self.num_estimated += int(np.count_nonzero(new_pairs))
 
-            # The epsilon factor (or exploration factor) determines how eager the algorithm is to randomly choose an unoptimal path
-            # As the algorithm starts to converge, the algorithm should focus more on exploitation, thus the epsilon factor get smaller
-            # The decline of the epsilon factor can be adjusted with "epsilon_mod"
-            epsilon_factor: float = 1.0 / (n * epsilon_mod + 1)
+        self.action_counts[pair_states, pair_actions] += counts
+        values: np.ndarray = self.action_values[pair_states, pair_actions]
 
-            episode = generate_episode(self.policy, self.grid_action_cb, self.grid_pos)
-            reward = 0.0
-            
-            total_reward = 0.0
-            self.total_state_visits_tracker.clear()
+        if step_size is None:
+            # The mean over all returns so far, updated with the sum of this episode's returns.
+            values += (np.bincount(inverse, weights=returns) - counts * values) / self.action_counts[pair_states, pair_actions]
+        else:
+            # The same as updating one return at a time in order of the visits: the j-th of m returns of a pair
+            # keeps a weight of step_size * (1 - step_size)^(m - 1 - j).
+            order: np.ndarray = np.argsort(inverse, kind="stable")
+            rank = np.empty(len(inverse), dtype=np.int64)
+            rank[order] = np.arange(len(inverse)) - np.repeat(np.cumsum(counts) - counts, counts)
 
-            for s in reversed(episode):
-                # Calculate state-action pair value*
-                total_reward += s[2]
-                reward = gamma_factor * reward + s[2]
+            weights = step_size * (1.0 - step_size) ** (counts[inverse] - 1 - rank)
+            values = (1.0 - step_size) ** counts * values + np.bincount(inverse, weights=weights * returns)
 
-                if (not s[0] in self.total_state_visits_tracker):
-                    self.total_state_visits_tracker[s[0]] = True
-                    self.total_state_visits[s[0]] += 1
+        self.action_values[pair_states, pair_actions] = values
 
-                # Only add return value if state-action pair has not been visited (i.e. first-visit only)
-                # Note that "s[0] + s[1]" appends the two tuples of state and action (instead of summing their values), resulting in a 4-int tuple
-                if (s[0] + s[1]) not in visited_state_actions:
-                    visited_state_actions.append(s[0] + s[1])
+        return np.unique(pair_states)
 
-                    if (s[1] not in state_action_returns[s[0]]):
-                        state_action_returns[s[0]][s[1]] = list()
+    def greedy_actions(self, states: np.ndarray = slice(None)) -> np.ndarray:
+        """The best estimated action of the given states (all by default), ties go to the pair estimated first."""
+        no_estimate: int = np.iinfo(np.int64).max
+        estimates = np.where(self.action_counts[states] > 0, self.action_values[states], -np.inf)
+        is_best = estimates == estimates.max(axis=1, keepdims=True)
 
-                    state_action_returns[s[0]][s[1]].append(reward)
+        return np.argmin(np.where(is_best, self.first_estimate[states], no_estimate), axis=1)
 
-                    # Calculate average state-action pair value based on average
-                    state_action_vals[s[0]][s[1]] = np.mean(state_action_returns[s[0]][s[1]])
+    def improve_policy(self, states: np.ndarray, epsilon_factor: float) -> None:
+        """Makes the policy of the given states epsilon-greedy with respect to the estimates."""
+        # Select the best action from the estimated state-action pairs of every state
+        best_actions = self.greedy_actions(states)
 
-                    # Select best action from state-action pairs
-                    best_action = max(state_action_vals[s[0]], key = state_action_vals[s[0]].get)
-                    self.policy[s[0]][best_action] = (1.0 - epsilon_factor + epsilon_factor / len(self.policy[s[0]]))
+        for s, best_action in zip(states.tolist(), best_actions.tolist()):
+            self.policy[s][best_action] = (1.0 - epsilon_factor + epsilon_factor / len(self.policy[s]))
 
-                    # Assign exploration probabilities according to epsilon factor
-                    for act in self.policy[s[0]].keys():
-                        if (act != best_action):
-                            self.policy[s[0]][act] = epsilon_factor / len(self.policy[s[0]])
-                
-            self.total_rewards.append(total_reward)
+            # Assign exploration probabilities according to epsilon factor
+            for act in self.policy[s].keys():
+                if (act != best_action):
+                    self.policy[s][act] = epsilon_factor / len(self.policy[s])
         
     def terminate(self):
         super().terminate(self)
\ No newline at end of file
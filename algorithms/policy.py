@@ -0,0 +1,111 @@
+import bisect
+from itertools import chain
+
+import numpy as np
+
+from math_utils import ACTIONS
+
+class ActionProbabilities(dict):
+    """The action probabilities of a single state. Every change marks the state as stale in the Policy it belongs to."""
+    def __init__(self, owner: "Policy", state: int, probabilities: dict[int, float] = ()):
+        super().__init__(probabilities)
+        self.owner: Policy = owner
+        self.state: int = state
+
+    def __setitem__(self, action: int, probability: float) -> None:
+        super().__setitem__(action, probability)
+        self.owner.stale.add(self.state)
+
+    def __delitem__(self, action: int) -> None:
+        super().__delitem__(action)
+        self.owner.stale.add(self.state)
+
+    def clear(self) -> None:
+        super().clear()
+        self.owner.stale.add(self.state)
+
+    def update(self, *args, **kwargs) -> None:
+        super().update(*args, **kwargs)
+        self.owner.stale.add(self.state)
+
+    def pop(self, *args) -> float:
+        self.owner.stale.add(self.state)
+        return super().pop(*args)
+
+    def popitem(self) -> tuple[int, float]:
+        self.owner.stale.add(self.state)
+        return super().popitem()
+
+    def setdefault(self, action: int, probability: float = None) -> float:
+        self.owner.stale.add(self.state)
+        return super().setdefault(action, probability)
+
+class Policy(dict):
+    """A policy keyed by flat state ids, with the action probabilities of each state as a dict, like a plain
+    dict[int, dict[int, float]]. It also keeps a compiled copy: a dense (S, A) probability matrix and its cumulative
+    sums per state, so that sampling an action is a bisection over a single row. The compiled copy is only rebuilt
+    for the states that changed, when it is used.
+    """
+    def __init__(self, num_states: int):
+        super().__init__()
+        self.num_states: int = num_states
+
+        self.probabilities: np.ndarray = np.zeros((num_states, len(ACTIONS)))
+        self.cumulative: np.ndarray = np.zeros((num_states, len(ACTIONS)))
+        # The rows of cumulative as lists, bisecting a list is cheaper than indexing an array for a single sample.
+        self.cumulative_rows: list[list[float]] = [[0.0] * len(ACTIONS) for _ in range(num_states)]
+
+        # States changed since the last refresh.
+        self.stale: set[int] = set()
+
+    def __setitem__(self, state: int, probabilities: dict[int, float]) -> None:
+        super().__setitem__(state, ActionProbabilities(self, state, probabilities))
+        self.stale.add(state)
+
+    def __delitem__(self, state: int) -> None:
+        super().__delitem__(state)
+        self.stale.add(state)
+
+    def refresh(self) -> None:
+        """Rebuilds the compiled copy of the states that changed since the last refresh."""
+        if not self.stale:
+            return
+
+        states = np.fromiter(self.stale, dtype=np.int64, count=len(self.stale))
+        self.stale.clear()
+
+        rows = np.zeros((len(states), len(ACTIONS)))
+        counts = [len(self.get(s, ())) for s in states.tolist()]
+        rows[np.repeat(np.arange(len(states)), counts), list(chain.from_iterable(self.get(s, {}).keys() for s in states.tolist()))] = \
+            list(chain.from_iterable(self.get(s, {}).values() for s in states.tolist()))
+
+        cumulative = np.cumsum(rows, axis=1)
+        self.probabilities[states] = rows
+        self.cumulative[states] = cumulative
+
+        for s, row in zip(states.tolist(), cumulative.tolist()):
+            self.cumulative_rows[s] = row
+
+    def sample(self, state: int, uniform: float) -> int:
+        """The action of the state at the given uniform sample in [0, 1)."""
+        if self.stale:
+            self.refresh()
+
+        row: list[float] = self.cumulative_rows[state]
+        if row[-1] <= 0.0:
+            raise ValueError("The policy of state {} has no action with a positive probability".format(state))
+
+        # The probabilities are scaled by their total, so rounding errors in the policy do not matter.
+        return bisect.bisect_right(row, uniform * row[-1])
+
+    def sample_batch(self, states: np.ndarray, uniforms: np.ndarray) -> np.ndarray:
+        """The actions of a batch of states, at the given uniform samples (one per state)."""
+        if self.stale:
+            self.refresh()
+
+        cumulative = self.cumulative[states]
+        if np.any(cumulative[:, -1] <= 0.0):
+            raise ValueError("The policy has states without an action with a positive probability")
+
+        # The sampled action is the number of cumulative probabilities at or below the sample.
+        return np.count_nonzero(cumulative <= (uniforms * cumulative[:, -1])[:, None], axis=1)
@@ -0,0 +1,293 @@
+from typing import Callable
+
+import numpy as np
+
+from algorithms.algorithm import Algorithm, Observation
+from algorithms.utils import TransitionModel
+
+def manhattan_distances(points: np.ndarray, grid_size: int) -> np.ndarray:
+    """Manhattan distance from every state to the nearest of the points (flat state ids), shape (S,), the grid's
+    longest distance when there are no points. A distance transform of two passes along each axis, each pass
+    vectorized over the other axis.
+    """
+    longest: int = 2 * (grid_size - 1)
+
+    # distances[y, x], the cells out of reach hold a distance longer than any in the grid.
+    distances = np.full(grid_size * grid_size, longest + 1, dtype=np.int64)
+    distances[points] = 0
+    distances = distances.reshape(grid_size, grid_size)
+
+    # Along x first, then along y over the distances along x.
+    for lines in (distances.T, distances):
+        for i in range(1, grid_size):
+            np.minimum(lines[i], lines[i - 1] + 1, out=lines[i])
+        for i in range(grid_size - 2, -1, -1):
+            np.minimum(lines[i], lines[i + 1] + 1, out=lines[i])
+
+    return np.minimum(distances.ravel(), longest)
+
+class TileFeatures:
+    """Sparse binary features of grid states, with the same number of weights for any grid size:
+    - tile coding over (x, y): num_tilings offset grids of tiles x tiles tiles, each tile covering grid_size / tiles cells,
+    - tile coding over the distance to the nearest hazard and to the nearest terminal state, on a log scale so that
+      short distances are told apart more finely,
+    - the distance to the nearest hazard as a real value, scaled by the longest distance in the grid, and the discount
+      over the distance to the nearest terminal state, gamma ** d (1 - d / longest distance without discounting), so
+      that values keep a slope towards the target within a tile as well,
+    - a bias feature that is always active.
+    Every state has one active binary feature per tiling per group, so the binary features of a batch of states are an
+    (N, K) array of indices into the weight vector. The weights of the two real features come last.
+    """
+    def __init__(self, grid_size: int, hazard_distances: np.ndarray, target_distances: np.ndarray, num_tilings: int = 8,
+                 tiles: int = 8, distance_tiles: int = 8, base_reward: float = 0.0, target_reward: float = 0.0,
+                 gamma_factor: float = 1.0):
+        self.grid_size: int = grid_size
+        # Manhattan distance from every state to the nearest hazard and to the nearest terminal state, shape (S,).
+        self.hazard_distances: np.ndarray = hazard_distances
+        self.target_distances: np.ndarray = target_distances
+        # The reward of moving into an empty cell and into the best terminal state, for the initial weights.
+        self.base_reward: float = base_reward
+        self.target_reward: float = target_reward
+        self.gamma_factor: float = gamma_factor
+
+        self.num_tilings: int = num_tilings
+        self.tiles: int = tiles
+        self.distance_tiles: int = distance_tiles
+
+        # Every tiling is shifted by a fraction of a tile, x and y by different amounts.
+        self.tile_width: float = grid_size / tiles
+        tilings = np.arange(num_tilings)
+        self.offsets_x: np.ndarray = (tilings / num_tilings) * self.tile_width
+        self.offsets_y: np.ndarray = ((3 * tilings) % num_tilings / num_tilings) * self.tile_width
+        self.distance_offsets: np.ndarray = tilings / num_tilings
+
+        # Each tiling has one extra tile per dimension, for the cells its offset pushes past the last one.
+        self.num_position_features: int = num_tilings * (tiles + 1) * (tiles + 1)
+        self.num_distance_features: int = num_tilings * (distance_tiles + 1)
+        self.num_features: int = self.num_position_features + 2 * self.num_distance_features + 3
+        self.num_active: int = 3 * num_tilings + 1
+
+        # The longest distance in the grid, that the distance features are scaled to.
+        self.max_distance: int = 2 * (grid_size - 1)
+
+        # The real valued features of every state, shape (S, 2). With discounting, the value of walking straight to
+        # the target is linear in gamma ** d, not in d.
+        if gamma_factor < 1.0:
+            target_discounts = gamma_factor ** target_distances.astype(np.float64)
+        else:
+            target_discounts = 1.0 - target_distances / max(self.max_distance, 1)
+        self.scaled: np.ndarray = np.stack((hazard_distances / max(self.max_distance, 1), target_discounts), axis=1)
+
+    @classmethod
+    def from_model(cls, model: TransitionModel, grid_size: int, **kwargs) -> "TileFeatures":
+        """Features of the grid of the transition tables. The reward of a cell is that of the moves into it, the
+        hazards (e.g. viruses) are the non-terminal cells with a lower reward than the most common one (empty cells).
+        """
+        num_states: int = model.next_state.shape[0]
+
+        moved = model.next_state != np.arange(num_states)[:, None]
+        cell_reward = np.full(num_states, np.nan)
+        cell_reward[model.next_state[moved]] = model.reward[moved]
+
+        rewards, counts = np.unique(cell_reward[~np.isnan(cell_reward)], return_counts=True)
+        base_reward: float = rewards[counts.argmax()] if len(rewards) > 0 else 0.0
+
+        hazards = np.flatnonzero((cell_reward < base_reward) & ~model.terminal)
+        targets = np.flatnonzero(model.terminal)
+        target_rewards = cell_reward[targets][~np.isnan(cell_reward[targets])]
+        target_reward: float = float(target_rewards.max()) if len(target_rewards) > 0 else 0.0
+
+        return cls(grid_size, manhattan_distances(hazards, grid_size), manhattan_distances(targets, grid_size),
+                   base_reward=float(base_reward), target_reward=target_reward, **kwargs)
+
+    def distance_tiles_of(self, distances: np.ndarray) -> np.ndarray:
+        """The tile of each distance in every tiling, shape (N, num_tilings)."""
+        scaled = np.log1p(distances) / np.log1p(max(self.max_distance, 1)) * self.distance_tiles
+        return np.minimum((scaled[:, None] + self.distance_offsets).astype(np.int64), self.distance_tiles)
+
+    def encode(self, states: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """The features of the states: the indices of the active binary features, shape (N, num_active), and the
+        real valued features of the nearest hazard and target, shape (N, 2).
+        """
+        xs, ys = states % self.grid_size, states // self.grid_size
+        tiles = self.tiles + 1
+
+        tile_xs = np.minimum(((xs[:, None] + self.offsets_x) / self.tile_width).astype(np.int64), self.tiles)
+        tile_ys = np.minimum(((ys[:, None] + self.offsets_y) / self.tile_width).astype(np.int64), self.tiles)
+        position = np.arange(self.num_tilings) * tiles * tiles + tile_xs * tiles + tile_ys
+
+        distance_base = self.num_position_features + np.arange(self.num_tilings) * (self.distance_tiles + 1)
+        hazard = distance_base + self.distance_tiles_of(self.hazard_distances[states])
+        target = distance_base + self.num_distance_features + self.distance_tiles_of(self.target_distances[states])
+
+        bias = np.full((len(states), 1), self.num_features - 3)
+
+        active = np.concatenate((position, hazard, target, bias), axis=1)
+
+        return active, self.scaled[states]
+
+class LinearTDAlgorithm(Algorithm):
+    """Q-learning or SARSA with a linear function of TileFeatures instead of a table, for grids too large for one.
+    The value of an action is that of its afterstate (the cell it moves to), w . phi(next state), so that the
+    distance features tell the actions apart. The weight vector has the same size for any grid, the features are
+    only computed for the states that are visited or asked for, and the greedy policy is derived on demand
+    (greedy_action) instead of being stored for every cell.
+    """
+    def __init__(self, policy: dict[int, dict[int, float]], grid_action_cb: Callable[[int, int], Observation],
+                 state: int, grid_size: int, model_cb: Callable[[], TransitionModel] = None, rng: np.random.Generator = None):
+        super().__init__(policy, grid_action_cb, state, grid_size, model_cb, rng)
+
+        self.features: TileFeatures = None
+        self.weights: np.ndarray = None
+        self.model: TransitionModel = None
+
+        self.total_rewards: list[float] = list()
+        # Number of episodes in which each state was visited, only for the visited states.
+        self.total_state_visits: dict[int, int] = dict()
+        # Number of episodes cut off at the step limit.
+        self.num_truncated: int = 0
+
+    def run(self, alpha_factor: float = 0.10, gamma_factor: float = 0.95, num_episodes: int = 200, max_steps: int = None,
+            method: str = "q_learning", epsilon_factor: float = None, min_epsilon: float = 0.05, num_tilings: int = 8,
+            tiles: int = 8, distance_tiles: int = 8, seed: int = None):
+        """Runs linear "q_learning" or "sarsa". Epsilon is epsilon_factor, or 1 / (n + 1) in episode n (but at least
+        min_epsilon) when it is None. Exploratory actions are drawn uniformly from the actions that move the agent,
+        ties between the best actions are broken at random. The step size is divided over the active features of a
+        state. The weights start from initial_weights, so that the first episodes already head for the target.
+        """
+        if method not in ("q_learning", "sarsa"):
+            raise ValueError("Unknown linear TD method '{}'".format(method))
+
+        self.seed(seed)
+
+        self.total_rewards.clear()
+        self.total_state_visits.clear()
+        self.num_truncated = 0
+
+        self.model = self.transition_model()
+        self.features = TileFeatures.from_model(self.model, self.grid_size, num_tilings=num_tilings, tiles=tiles,
+                                                distance_tiles=distance_tiles, gamma_factor=gamma_factor)
+        self.weights = self.initial_weights(gamma_factor)
+
+        step_size: float = alpha_factor / self.features.num_active
+
+        for n in range(num_episodes):
+            epsilon: float = max(1.0 / (n + 1), min_epsilon) if epsilon_factor is None else epsilon_factor
+            total_reward: float = 0.0
+            visited: set[int] = set()
+
+            s: int = self.state
+            if self.model.terminal[s]:
+                self.total_rewards.append(total_reward)
+                continue
+
+            active, scaled, values = self.action_values(s)
+            action: int = self.epsilon_greedy(s, values, epsilon)
+
+            num_steps: int = 0
+            while True:
+                num_steps += 1
+                visited.add(s)
+
+                next_s: int = int(self.model.next_state[s, action])
+                reward: float = float(self.model.reward[s, action])
+                total_reward += reward
+
+                # Update the weights of the afterstate of the action taken.
+                target: float = reward
+                next_action: int = None
+                if not self.model.terminal[next_s]:
+                    next_active, next_scaled, next_values = self.action_values(next_s)
+                    next_action = self.epsilon_greedy(next_s, next_values, epsilon)
+                    target += gamma_factor * float(next_values.max() if method == "q_learning" else next_values[next_action])
+
+                delta: float = target - values[action]
+                self.weights[active[action]] += step_size * delta
+                self.weights[-2:] += step_size * delta * scaled[action]
+
+                if self.model.terminal[next_s]:
+                    break
+
+                # Truncated, not terminal: the update above has bootstrapped from the state the episode stopped in.
+                if num_steps == max_steps:
+                    self.num_truncated += 1
+                    break
+
+                # The next values again, now that the weights (which the afterstates can share) changed.
+                s, action = next_s, next_action
+                active, scaled = next_active, next_scaled
+                values = np.where(np.isfinite(next_values), self.values(active, scaled), -np.inf)
+
+            self.total_rewards.append(total_reward)
+            for v in visited:
+                self.total_state_visits[v] = self.total_state_visits.get(v, 0) + 1
+
+    def initial_weights(self, gamma_factor: float) -> np.ndarray:
+        """Weights that value an afterstate d cells from the nearest target by walking straight to it: d - 1 moves
+        into empty cells and one into the target. Only the bias and the weight of the target feature are set, the
+        other features learn the corrections (e.g. around hazards and walls) on top of it.
+        """
+        weights = np.zeros(self.features.num_features)
+        base_reward, target_reward = self.features.base_reward, self.features.target_reward
+
+        if gamma_factor < 1.0:
+            # base_reward * (1 - gamma ** (d - 1)) / (1 - gamma) + gamma ** (d - 1) * target_reward
+            weights[-3] = base_reward / (1.0 - gamma_factor)
+            weights[-1] = (target_reward - weights[-3]) / gamma_factor
+        else:
+            # base_reward * (d - 1) + target_reward
+            weights[-3] = target_reward - base_reward
+            weights[-1] = -base_reward * max(self.features.max_distance, 1)
+
+        return weights
+
+    def values(self, active: np.ndarray, scaled: np.ndarray) -> np.ndarray:
+        """The linear values of encoded states."""
+        return self.weights[active].sum(axis=1) + scaled @ self.weights[-2:]
+
+    def action_values(self, state: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """The features of the afterstate of every action (see TileFeatures.encode) and the value of every action,
+        -inf for the actions that do not move the agent (unless none does).
+        """
+        afterstates = self.model.next_state[state]
+        active, scaled = self.features.encode(afterstates)
+        values = self.values(active, scaled)
+
+        moves = afterstates != state
+        if moves.any():
+            values[~moves] = -np.inf
+
+        return active, scaled, values
+
+    def epsilon_greedy(self, state: int, values: np.ndarray, epsilon: float) -> int:
+        if self.uniforms.uniform() < epsilon:
+            # A random action out of the ones that can be taken.
+            actions = np.flatnonzero(np.isfinite(values))
+            return int(actions[self.uniforms.integer(len(actions))])
+
+        return self.best_action(values)
+
+    def best_action(self, values: np.ndarray) -> int:
+        """One of the actions with the highest value, ties are broken at random."""
+        best = np.flatnonzero(values == values.max())
+        if len(best) == 1:
+            return int(best[0])
+
+        return int(best[self.uniforms.integer(len(best))])
+
+    def greedy_action(self, state: int) -> int:
+        """The greedy action of a state, computed from the weights when it is asked for."""
+        return self.best_action(self.action_values(state)[2])
+
+    def greedy_actions(self, states: np.ndarray) -> np.ndarray:
+        """The greedy actions of a batch of states, e.g. for plotting a part of the grid."""
+        afterstates = self.model.next_state[states]
+        values = self.values(*self.features.encode(afterstates.ravel())).reshape(afterstates.shape)
+
+        moves = afterstates != states[:, None]
+        values = np.where(moves | ~moves.any(axis=1, keepdims=True), values, -np.inf)
+
+        return values.argmax(axis=1)
+
+    def terminate(self):
+        pass
@@ -1,47 +1,121 @@
-import random
 from typing import Callable
 
+import numpy as np
+
 from algorithms.algorithm import Algorithm, Observation
-from algorithms.utils import sample_policy_action
+from algorithms.kernels import policy_cumulative, run_q_learning_episode
+from algorithms.utils import (ConvergenceMonitor, LearnedModel, ReplayBuffer, TransitionModel, VisitCounter, decay_traces,
+                             policy_action_mask, sample_policy_action, visit_trace)
+from env import VectorSchoolEnv
+from math_utils import ACTIONS
 
 class QLearningAlgorithm(Algorithm):
-    def __init__(self, policy: dict[tuple[int, int], dict[tuple[int, int], float]], grid_action_cb: Callable[[tuple[int, int], tuple[int, int]], Observation], 
-                 grid_pos: tuple[int, int], grid_size: int):
-        super().__init__(policy, grid_action_cb, grid_pos, grid_size)
+    def __init__(self, policy: dict[int, dict[int, float]], grid_action_cb: Callable[[int, int], Observation], 
+                 state: int, grid_size: int, model_cb: Callable[[], TransitionModel] = None, rng: np.random.Generator = None):
+        super().__init__(policy, grid_action_cb, state, grid_size, model_cb, rng)
 
-        self.q_table: dict[tuple[int, int], dict[tuple[int, int], float]] = dict()
+        # Q-values of every state-action pair, shape (S, A). Actions that are not in the policy hold -inf,
+        # so that a plain argmax (or max) over a row only considers the valid actions.
+        self.q_table: np.ndarray = None
+        self.action_mask: np.ndarray = None
         self.total_rewards: list[float] = list()
-        self.total_state_visits: dict[tuple[int, int], int] = dict()
-        self.total_state_visits_tracker: dict[tuple[int, int], bool] = dict()
+        self.total_state_visits: dict[int, int] = dict()
+        self.total_state_visits_tracker: dict[int, bool] = dict()
+        # Number of episodes cut off at the step limit.
+        self.num_truncated: int = 0
+        # Number of steps taken in the environment over all episodes.
+        self.num_interactions: int = 0
+        # Number of episodes run when the run stopped early on convergence, None when all episodes ran.
+        self.stopped_episode: int = None
+
+        # Experience kept for replay and planning, see run.
+        self.replay_buffer: ReplayBuffer = None
+        self.model: LearnedModel = None
+
+    def run(self, alpha_factor: float = 0.10, gamma_factor: float = 0.95, num_episodes: int = 200, max_steps: int = None,
+            seed: int = None, lambda_factor: float = 0.0, traces: str = "replacing", trace_cutoff: float = 0.01,
+            planning_steps: int = 0, replay_batch: int = 0, replay_capacity: int = 10000, num_envs: int = None,
+            patience: int = None, tolerance: float = None, window: int = 10, backend: str = "python"):
+        """Runs Q-learning. With a lambda_factor above 0 it runs Watkins's Q(lambda): every update also goes to the
+        recently visited state-action pairs, weighted by their eligibility traces ("replacing" or "accumulating").
+        Traces decay by gamma * lambda per step, are dropped below trace_cutoff and are cut after an exploratory action.
+        Real transitions can be used more than once: with planning_steps it runs Dyna-Q, every step is followed by that
+        many updates of pairs sampled from a deterministic model learned from the transitions so far. With replay_batch,
+        every step is followed by an update of a batch sampled from the last replay_capacity transitions.
+        With num_envs, that many episodes are run in lockstep on the transition tables instead (see run_batched).
+        With patience or tolerance the run stops early once it converged, see ConvergenceMonitor.
+        The backend "jit" runs every episode in a single kernel call on the transition tables (see run_jit).
+        """
+        if traces not in ("accumulating", "replacing"):
+            raise ValueError("Unknown eligibility traces '{}'".format(traces))
+
+        if backend not in ("python", "jit"):
+            raise ValueError("Unknown Q-learning backend '{}'".format(backend))
+
+        self.seed(seed)
 
-    def run(self, alpha_factor: float = 0.10, gamma_factor: float = 0.95, num_episodes: int = 200):
         # Total rewards tracker (only for plotting total rewards, not functionally required)
         self.total_rewards.clear()
+        self.num_truncated = 0
+        self.num_interactions = 0
+        self.stopped_episode = None
+
+        monitor = ConvergenceMonitor(patience, tolerance, window) if patience is not None or tolerance is not None else None
+
+        self.model = LearnedModel(self.grid_size * self.grid_size, len(ACTIONS)) if planning_steps > 0 else None
+        self.replay_buffer = ReplayBuffer(replay_capacity) if replay_batch > 0 else None
 
-        # Initialize Q-table to all 0.0
-        for x in range(self.grid_size):
-            for y in range(self.grid_size):
-                self.q_table[(x,y)] = dict()
-                self.total_state_visits[(x,y)] = 0
+        # Initialize Q-table to all 0.0 for the actions in the policy
+        self.action_mask = policy_action_mask(self.policy, self.grid_size * self.grid_size)
+        self.q_table = np.where(self.action_mask, 0.0, -np.inf)
 
-                for action in self.policy[(x,y)].keys():
-                    self.q_table[(x,y)][action] = 0.0
+        for s in range(self.grid_size * self.grid_size):
+            self.total_state_visits[s] = 0
+
+        if num_envs is not None:
+            if lambda_factor > 0.0 or planning_steps > 0 or replay_batch > 0:
+                raise ValueError("Batched Q-learning does not support traces, planning or replay")
+
+            self.run_batched(alpha_factor, gamma_factor, num_episodes, max_steps, num_envs, monitor)
+            self.get_best_policy()
+            return
+
+        if backend == "jit":
+            if lambda_factor > 0.0 or planning_steps > 0 or replay_batch > 0:
+                raise ValueError("The jit backend does not support traces, planning or replay")
+
+            self.run_jit(alpha_factor, gamma_factor, num_episodes, max_steps, monitor)
+            self.get_best_policy()
+            return
 
         for n in range(num_episodes):
             total_reward: float = 0.0
 
             epsilon_factor: float = 1.0 / (n + 1)
-            curr_state = self.grid_action_cb(self.grid_pos)
+            curr_state = self.grid_action_cb(self.state)
 
             # Purely for plotting, not functional
             self.total_state_visits_tracker.clear()
 
-            # Traverse episode until completion
+            # Sparse eligibility traces, keyed by s * A + a. With traces the next action is chosen ahead.
+            eligibility: dict[int, float] = dict()
+            action: int = None
+
+            # Traverse episode until completion, or until the step limit
+            num_steps: int = 0
             while (True):
                 if (curr_state.is_terminal):
                     break
 
-                s: tuple[int, int] = curr_state.grid_pos
+                if (num_steps == max_steps):
+                    # Truncated, not terminal: the last update has bootstrapped from the state the episode stopped in.
+                    self.num_truncated += 1
+                    break
+
+                num_steps += 1
+                self.num_interactions += 1
+
+                s: int = curr_state.state
 
                 # Purely for plotting, not functional
                 if (not s in self.total_state_visits_tracker):
@@ -49,34 +123,196 @@ class QLearningAlgorithm(Algorithm):
                     self.total_state_visits[s] += 1
 
                 # Perform action using behaviour policy, observe reward and next state
-                action: tuple[int, int] = self.epsilon_greedy(s, epsilon_factor)
+                if (action is None):
+                    action = self.epsilon_greedy(s, epsilon_factor)
                 next_state: Observation = self.grid_action_cb(s, action)
                 total_reward += next_state.reward
 
+                next_action: int = None
+                if (lambda_factor > 0.0 and not next_state.is_terminal and num_steps != max_steps):
+                    next_action = self.epsilon_greedy(next_state.state, epsilon_factor)
+
                 # Calculate Q-value based on best action (NOT the actual action taken, Q-Learning is off-policy!) and next state
-                best_next_action: tuple[int, int] = max(self.q_table[next_state.grid_pos], key = self.q_table[next_state.grid_pos].get)
-                target = next_state.reward + (gamma_factor * self.q_table[next_state.grid_pos][best_next_action] * (not next_state.is_terminal))
-                self.q_table[s][action] += alpha_factor * (target - self.q_table[s][action])
+                target = next_state.reward
+                greedy_next: bool = False
+                if (not next_state.is_terminal):
+                    next_values = self.q_table[next_state.state]
+                    best_next_value = float(next_values[next_values.argmax()])
+                    target += gamma_factor * best_next_value
+                    greedy_next = next_action is not None and next_values[next_action] == best_next_value
+
+                if (lambda_factor > 0.0):
+                    delta: float = target - self.q_table[s, action]
+                    visit_trace(eligibility, s * len(ACTIONS) + action, traces)
+
+                    for key, trace in eligibility.items():
+                        self.q_table.flat[key] += alpha_factor * delta * trace
+
+                    # The traces follow the greedy policy, an exploratory next action cuts them off.
+                    if (greedy_next):
+                        eligibility = decay_traces(eligibility, gamma_factor * lambda_factor, trace_cutoff)
+                    else:
+                        eligibility.clear()
+                else:
+                    self.q_table[s, action] += alpha_factor * (target - self.q_table[s, action])
+
+                # Learn from the stored experience as well, without stepping the environment
+                if (self.model is not None):
+                    self.model.add(s, action, next_state.reward, next_state.state, next_state.is_terminal)
+                    self.batch_update(*self.model.sample(planning_steps, self.rng), alpha_factor, gamma_factor)
+
+                if (self.replay_buffer is not None):
+                    self.replay_buffer.add(s, action, next_state.reward, next_state.state, next_state.is_terminal)
+                    self.batch_update(*self.replay_buffer.sample(replay_batch, self.rng), alpha_factor, gamma_factor)
 
                 # Update state
                 curr_state = next_state
+                action = next_action
             
             self.total_rewards.append(total_reward)
 
+            if (monitor is not None and monitor.update(lambda: self.q_table.argmax(axis=1), self.q_table)):
+                self.stopped_episode = n + 1
+                break
+
         # Extract target policy
         self.get_best_policy()
 
-    def epsilon_greedy(self, state: tuple[int, int], epsilon_factor: float):
+    def batch_update(self, states: np.ndarray, actions: np.ndarray, rewards: np.ndarray, next_states: np.ndarray,
+                     terminals: np.ndarray, alpha_factor: float, gamma_factor: float):
+        """Q-learning updates of a batch of transitions at once, with the targets computed from the current Q-table.
+        A pair that occurs k times in the batch is moved to its mean target with a step of 1 - (1 - alpha)^k, as k
+        updates in a row would, instead of adding up k steps (which overshoots while only a few pairs are known).
+        """
+        next_values = self.q_table[next_states].max(axis=1)
+        targets = rewards + gamma_factor * np.where(terminals, 0.0, next_values)
+
+        # Sum of the targets and number of updates of every pair, duplicates are accumulated by np.add.at
+        keys = states * len(ACTIONS) + actions
+        target_sums = np.zeros(self.q_table.size)
+        counts = np.zeros(self.q_table.size)
+        np.add.at(target_sums, keys, targets)
+        np.add.at(counts, keys, 1.0)
+
+        # Duplicate keys all get the same new value
+        step = 1.0 - (1.0 - alpha_factor) ** counts[keys]
+        self.q_table.flat[keys] += step * (target_sums[keys] / counts[keys] - self.q_table.flat[keys])
+
+    def run_jit(self, alpha_factor: float, gamma_factor: float, num_episodes: int, max_steps: int, monitor: ConvergenceMonitor = None):
+        """The episodes of run, each run by q_learning_kernel: compiled with Numba when it is installed, otherwise the
+        same kernel runs as Python. The kernel takes the uniforms in the same order as the python backend, so that both
+        give the same results for the same seed.
+        """
+        model: TransitionModel = self.transition_model()
+        cumulative: np.ndarray = policy_cumulative(self.policy, self.grid_size * self.grid_size)
+
+        visits = np.zeros(self.grid_size * self.grid_size, dtype=np.int64)
+        visited = np.zeros(self.grid_size * self.grid_size, dtype=bool)
+
+        for n in range(num_episodes):
+            total_reward, num_steps, is_truncated = run_q_learning_episode(
+                self.q_table, model, cumulative, self.state, alpha_factor, gamma_factor, 1.0 / (n + 1), max_steps, self.uniforms, visits, visited)
+
+            self.total_rewards.append(total_reward)
+            self.num_interactions += num_steps
+            self.num_truncated += is_truncated
+
+            if (monitor is not None and monitor.update(lambda: self.q_table.argmax(axis=1), self.q_table)):
+                self.stopped_episode = n + 1
+                break
+
+        self.total_state_visits.update(enumerate(visits.tolist()))
+
+    def run_batched(self, alpha_factor: float, gamma_factor: float, num_episodes: int, max_steps: int, num_envs: int,
+                    monitor: ConvergenceMonitor = None):
+        """Runs num_envs episodes in lockstep, one per agent of a VectorSchoolEnv on the transition tables: every tick
+        picks the epsilon-greedy actions of all agents with one masked argmax, steps them all and updates the Q-table
+        with batch_update. An agent whose episode finished starts the next one until num_episodes episodes have run,
+        after that it is retired. Epsilon is 1 / (n + 1) with n the number of finished episodes, as in the sequential
+        run, so that episodes started early on all explore. The exploratory actions are samples of the behaviour
+        policy, which has to be a Policy. The monitor is updated after every tick in which episodes finished, a stop
+        drops the unfinished episodes.
+        """
+        model: TransitionModel = self.transition_model()
+        num_states: int = self.grid_size * self.grid_size
+
+        vector_env = VectorSchoolEnv.from_model(model, self.state, self.grid_size, min(num_envs, num_episodes), max_steps)
+        states = vector_env.reset()
+
+        # The episode every agent runs, -1 once it is retired.
+        episodes = np.arange(vector_env.num_envs)
+        next_episode: int = vector_env.num_envs
+        num_finished: int = 0
+
+        total_rewards = np.zeros(num_episodes)
+        finished = np.zeros(num_episodes, dtype=bool)
+        if model.terminal[self.state]:
+            # Every episode ends before its first step
+            episodes.fill(-1)
+            finished[:] = True
+
+        # The states visited in every episode, counted once the episode finished.
+        visits = VisitCounter(num_states)
+
+        running = np.flatnonzero(episodes >= 0)
+        while len(running) > 0:
+            # Epsilon-greedy actions: a sample of the behaviour policy, or the best action (ties go to the lowest id).
+            epsilon_factor: float = 1.0 / (num_finished + 1)
+            explore = self.rng.random(vector_env.num_envs) < epsilon_factor
+            random_actions = self.policy.sample_batch(states, self.rng.random(vector_env.num_envs))
+            actions = np.where(explore, random_actions, self.q_table[states].argmax(axis=1))
+
+            observation = vector_env.step(actions)
+            rewards = observation.rewards.astype(float)
+            is_terminal = observation.is_terminal
+            is_truncated = observation.is_truncated & ~is_terminal
+
+            # Retired agents keep stepping along, only the running ones learn.
+            self.batch_update(states[running], actions[running], rewards[running], observation.states[running],
+                              is_terminal[running], alpha_factor, gamma_factor)
+
+            total_rewards[episodes[running]] += rewards[running]
+            visits.add(episodes[running], states[running])
+            self.num_interactions += len(running)
+            self.num_truncated += int(np.count_nonzero(is_truncated[running]))
+            states = observation.reset_states
+
+            # The agents that finished start the next episodes, or are retired when all episodes have started.
+            done = running[(is_terminal | is_truncated)[running]]
+            if len(done) == 0:
+                continue
+
+            num_finished += len(done)
+            finished[episodes[done]] = True
+
+            visits.flush(finished)
+
+            if (monitor is not None and monitor.update(lambda: self.q_table.argmax(axis=1), self.q_table, len(done))):
+                self.stopped_episode = num_finished
+                break
+
+            num_new: int = min(len(done), num_episodes - next_episode)
+            episodes[done[:num_new]] = np.arange(next_episode, next_episode + num_new)
+            episodes[done[num_new:]] = -1
+            next_episode += num_new
+            running = np.flatnonzero(episodes >= 0)
+
+        self.total_rewards.extend(total_rewards[finished].tolist())
+
+        visits.flush(finished, force=True)
+        self.total_state_visits.update(enumerate(visits.visits.tolist()))
+
+    def epsilon_greedy(self, state: int, epsilon_factor: float):
         # Epsilon-greedy action select (policy is assumed to be random until the end of the algorithm, thus sample policy will result in a random action)
-        if (random.uniform(0, 1) < epsilon_factor):
-            return sample_policy_action(self.policy, state)
+        if (self.uniforms.uniform() < epsilon_factor):
+            return sample_policy_action(self.policy, state, self.uniforms)
         else:
-            return max(self.q_table[state], key = self.q_table[state].get)
+            # Ties go to the lowest action id, the order in which Agent.init_policy adds the actions.
+            return int(self.q_table[state].argmax())
         
     def get_best_policy(self):
         # Extract target policy based on max Q-values
-        for state in self.q_table.keys():
-            best_action = max(self.q_table[state], key = self.q_table[state].get)
+        for state, best_action in enumerate(self.q_table.argmax(axis=1).tolist()):
             self.policy[state].clear()
             self.policy[state][best_action] = 1.0
     
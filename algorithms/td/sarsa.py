@@ -1,163 +1,266 @@
-import random
 from typing import Callable
 
+import numpy as np
+
 from algorithms.algorithm import Algorithm, Observation
-from algorithms.utils import generate_episode, sample_policy_action
+from algorithms.kernels import policy_cumulative, run_sarsa_episode
+from algorithms.utils import ConvergenceMonitor, TransitionModel, decay_traces, generate_episode, policy_action_mask, sample_policy_action, visit_trace
 
 class TDSarsaAlgorithm(Algorithm):
-    def __init__(self, policy: dict[tuple[int, int], dict[tuple[int, int], float]], grid_action_cb: Callable[[tuple[int, int], tuple[int, int]], Observation], 
-                 grid_pos: tuple[int, int], grid_size: int):
+    def __init__(self, policy: dict[int, dict[int, float]], grid_action_cb: Callable[[int, int], Observation], 
+                 state: int, grid_size: int, model_cb: Callable[[], TransitionModel] = None, rng: np.random.Generator = None):
 
-        super().__init__(policy, grid_action_cb, grid_pos, grid_size)
+        super().__init__(policy, grid_action_cb, state, grid_size, model_cb, rng)
 
-        self.q_table: dict[tuple[int, int], dict[tuple[int, int], float]] = dict()
         self.total_rewards: list[float] = list()
-        self.total_state_visits: dict[tuple[int, int], int] = dict()
-        self.total_state_visits_tracker: dict[tuple[int, int], bool] = dict()
-
-        self.state_values: dict[tuple[int, int], float] = dict()
-
-    def move(self, grid_pos: tuple[int, int] = None) -> tuple[int, int]:
-        return sample_policy_action(grid_pos, self.policy)
+        self.total_state_visits: dict[int, int] = dict()
+        self.total_state_visits_tracker: dict[int, bool] = dict()
+        # Number of episodes cut off at the step limit.
+        self.num_truncated: int = 0
+        # Number of episodes run when the run stopped early on convergence, None when all episodes ran.
+        self.stopped_episode: int = None
+
+        self.state_values: dict[int, float] = dict()
+
+        # Afterstate of every state-action pair, shape (S, A), see build_neighbours.
+        self.action_mask: np.ndarray = None
+        self.neighbour_states: np.ndarray = None
+        self.neighbour_rewards: np.ndarray = None
+        self.neighbour_terminal: np.ndarray = None
+        self.terminal_action: list[int] = None
+        # Discount of the run, an action is judged by its reward plus the discounted value of its afterstate.
+        self.gamma_factor: float = None
+
+    def move(self, state: int = None) -> int:
+        return sample_policy_action(self.policy, state, self.uniforms)
+
+    def build_neighbours(self) -> None:
+        """Caches the afterstate of every action of every state (next state, reward and whether it is terminal),
+        so that greedy selection looks them up instead of stepping the environment for each action.
+        """
+        model: TransitionModel = self.transition_model()
+
+        self.action_mask = policy_action_mask(self.policy, self.grid_size * self.grid_size)
+        self.neighbour_states = model.next_state.astype(np.intp)
+        self.neighbour_rewards = model.reward.astype(float)
+        self.neighbour_terminal = model.terminal[model.next_state] & self.action_mask
+
+        # The first action of each state that leads to a terminal state (-1 if none), as a list for quick lookups.
+        self.terminal_action: list[int] = np.where(self.neighbour_terminal.any(axis=1), self.neighbour_terminal.argmax(axis=1), -1).tolist()
+
+    def best_actions(self, values: np.ndarray, pos: int) -> np.ndarray:
+        """The actions of the state with the highest reward plus discounted value of the neighbour they lead to."""
+        eval_actions = np.where(self.action_mask[pos], self.neighbour_rewards[pos] + self.gamma_factor * values[self.neighbour_states[pos]], -np.inf)
+        return (eval_actions == eval_actions[eval_actions.argmax()]).nonzero()[0]
+
+    def greedy_actions(self, values: np.ndarray) -> np.ndarray:
+        """The first best action of every state, see best_actions."""
+        return np.where(self.action_mask, self.neighbour_rewards + self.gamma_factor * values[self.neighbour_states], -np.inf).argmax(axis=1)
 
     # Process the state values in order to update the movement strategy.
-    def process_state_values(self, state_values: dict[(int, int), float]) -> None:
-        # For each Cell in the grid update the movement strategy based on the state values.
-        for x in range(self.grid_size):
-            for y in range(self.grid_size):
-                eval_actions: dict[(int, int), float] = {}
-
-                # Construct position based on the x and y coordinates.
-                pos = (x, y)
-                for a in self.policy[pos]:
-                    # Create the new position based on the action and the current position.
-                    next_state: Observation = self.grid_action_cb(pos, a)
+    def process_state_values(self, state_values: dict[int, float]) -> None:
+        values = np.array([state_values[s] for s in range(self.grid_size * self.grid_size)])
 
-                    # If a final state is among the actions, it is taken as the only actions.
-                    if next_state.is_terminal:
-                        eval_actions.clear()
-                        eval_actions[a] = next_state.reward
-                        break
+        # For each Cell in the grid, the best actions are those with the highest reward plus discounted state value.
+        eval_actions = np.where(self.action_mask, self.neighbour_rewards + self.gamma_factor * values[self.neighbour_states], -np.inf)
+        best = eval_actions == eval_actions.max(axis=1, keepdims=True)
 
-                    next_reward: float = state_values[next_state.grid_pos]
-                    eval_actions[a] = next_reward
+        # If a final state is among the actions, the first of those is taken as the only action.
+        has_terminal = self.neighbour_terminal.any(axis=1)
+        first_terminal = np.argmax(self.neighbour_terminal, axis=1)
+        best[has_terminal] = False
+        best[np.flatnonzero(has_terminal), first_terminal[has_terminal]] = True
 
-                # Get the best actions of the current state, based on the highest value associated.
-                best_actions: list[(int, int)] = [action for action, reward in eval_actions.items() if
-                                                  reward == max(eval_actions.values())]
-                # Get the new probability distribution based on the number of best actions.
-                action_prob: float = 1 / len(best_actions)
-                new_actions: dict[(int, int), float] = {}
+        # Get the new probability distribution based on the number of best actions.
+        probabilities = best / best.sum(axis=1, keepdims=True)
 
-                for action in best_actions:
-                    new_actions[action] = action_prob
-
-                self.policy[pos] = new_actions
+        for pos in range(self.grid_size * self.grid_size):
+            best_actions = np.flatnonzero(best[pos])
+            self.policy[pos] = dict(zip(best_actions.tolist(), probabilities[pos, best_actions].tolist()))
 
 
     # Runs the TD Sarsa algorithm and returns a list of state values.
-    def run(self, alpha_factor: float = 0.10, gamma_factor: float = 0.95, epsilon_factor: int = 0.05, num_episodes: int = 100):
+    def run(self, alpha_factor: float = 0.10, gamma_factor: float = 0.95, epsilon_factor: int = 0.05, num_episodes: int = 100,
+            max_steps: int = None, seed: int = None, lambda_factor: float = 0.0, traces: str = "replacing", trace_cutoff: float = 0.01,
+            patience: int = None, tolerance: float = None, window: int = 10, backend: str = "python"):
+        """Runs TD SARSA on the state values. With a lambda_factor above 0 it runs SARSA(lambda): every update also goes
+        to the recently visited states, weighted by their eligibility traces ("replacing" or "accumulating").
+        Traces decay by gamma * lambda per step, are dropped below trace_cutoff and are cut after an exploratory action.
+        With patience or tolerance the run stops early once it converged, see ConvergenceMonitor.
+        The backend "jit" runs every episode in a single kernel call on the afterstate cache (see run_jit).
+        """
+        if traces not in ("accumulating", "replacing"):
+            raise ValueError("Unknown eligibility traces '{}'".format(traces))
+
+        if backend not in ("python", "jit"):
+            raise ValueError("Unknown SARSA backend '{}'".format(backend))
+
+        if backend == "jit" and lambda_factor > 0.0:
+            raise ValueError("The jit backend does not support traces")
+
+        self.seed(seed)
+
         # Create a dictionary with all cells of the grid, having a value of 0.
-        self.state_values: dict[tuple[int, int], float] = dict()
+        self.state_values: dict[int, float] = dict()
 
         self.total_rewards.clear()
+        self.num_truncated = 0
+        self.stopped_episode = None
+        self.gamma_factor = gamma_factor
+
+        monitor = ConvergenceMonitor(patience, tolerance, window) if patience is not None or tolerance is not None else None
+
+        self.build_neighbours()
+
+        # The state values are kept in an array during the run, for the vectorized greedy selection.
+        values = np.zeros(self.grid_size * self.grid_size)
 
         # Initialize value table to all 0.0
-        for x in range(self.grid_size):
-            for y in range(self.grid_size):
-                self.state_values[(x,y)] = 0.0
-                self.total_state_visits[(x,y)] = 0
+        for s in range(self.grid_size * self.grid_size):
+            self.total_state_visits[s] = 0
+
+        if backend == "jit":
+            self.run_jit(values, alpha_factor, gamma_factor, epsilon_factor, num_episodes, max_steps, monitor)
+            self.state_values.update(enumerate(values.tolist()))
+            self.process_state_values(self.state_values)
+            return
 
         # Iterate for the number of episodes defined.
         for n in range(num_episodes):
             total_reward: float = 0.0
 
-            current_pos: Observation = self.grid_action_cb(self.grid_pos)
+            current_pos: int = self.state
 
             # Get an initial action for the episode using epsilon greedy.
-            action = self.epsilon_greedy(self.state_values, current_pos.grid_pos, epsilon_factor)
+            action = self.epsilon_greedy(values, current_pos, epsilon_factor)
 
             # Purely for plotting, not functional
             self.total_state_visits_tracker.clear()
 
-            # Iterate until a terminal state is found.
+            # Sparse eligibility traces of the recently visited states.
+            eligibility: dict[int, float] = dict()
+
+            # Iterate until a terminal state is found, or until the step limit.
+            num_steps: int = 0
             while True:
+                num_steps += 1
                 
                 # Purely for plotting, not functional
-                if (not current_pos.grid_pos in self.total_state_visits_tracker):
-                    self.total_state_visits_tracker[current_pos.grid_pos] = True
-                    self.total_state_visits[current_pos.grid_pos] += 1
-
-                # Get the name state for the given action.
-                state_prime: Observation = self.grid_action_cb(current_pos.grid_pos, action)
-                # Get the reward for the given action.
-                reward: float = state_prime.reward
+                if (not current_pos in self.total_state_visits_tracker):
+                    self.total_state_visits_tracker[current_pos] = True
+                    self.total_state_visits[current_pos] += 1
+
+                # Get the new state, its reward and whether it is terminal for the given action, from the cache.
+                state_prime: int = int(self.neighbour_states[current_pos, action])
+                reward: float = float(self.neighbour_rewards[current_pos, action])
+                is_terminal: bool = bool(self.neighbour_terminal[current_pos, action])
                 # Get a new action given the new state, using epsilon greedy.
-                action_prime = self.epsilon_greedy(self.state_values, state_prime.grid_pos, epsilon_factor)
+                action_prime = self.epsilon_greedy(values, state_prime, epsilon_factor)
                 # Update the state values.
-                self.state_values[current_pos.grid_pos] += alpha_factor * (reward + gamma_factor * self.state_values[state_prime.grid_pos] - self.state_values[current_pos.grid_pos])
+                delta: float = reward + gamma_factor * values[state_prime] - values[current_pos]
+                if lambda_factor > 0.0:
+                    visit_trace(eligibility, current_pos, traces)
+
+                    for s, trace in eligibility.items():
+                        values[s] += alpha_factor * delta * trace
+
+                    # An exploratory next action cuts the traces off, so that its outcome is not credited to the path before it.
+                    if self.is_greedy(values, state_prime, action_prime):
+                        eligibility = decay_traces(eligibility, gamma_factor * lambda_factor, trace_cutoff)
+                    else:
+                        eligibility.clear()
+                else:
+                    values[current_pos] += alpha_factor * delta
                 # Update the position and action for the next iteration.
                 current_pos = state_prime
                 action = action_prime
 
-                total_reward += state_prime.reward
+                total_reward += reward
 
                 # Break if the new state is terminal.
-                if state_prime.is_terminal:
+                if is_terminal:
+                    break
+
+                # Truncated, not terminal: the update above has bootstrapped from the state the episode stopped in.
+                if num_steps == max_steps:
+                    self.num_truncated += 1
                     break
 
             self.total_rewards.append(total_reward)
 
+            if monitor is not None and monitor.update(lambda: self.greedy_actions(values), values):
+                self.stopped_episode = n + 1
+                break
+
+        self.state_values.update(enumerate(values.tolist()))
         self.process_state_values(self.state_values)
 
+    def run_jit(self, values: np.ndarray, alpha_factor: float, gamma_factor: float, epsilon_factor: float, num_episodes: int,
+                max_steps: int, monitor: ConvergenceMonitor = None) -> None:
+        """The episodes of run, each run by sarsa_kernel: compiled with Numba when it is installed, otherwise the same
+        kernel runs as Python. The kernel takes the uniforms in the same order as the python backend, so that both give
+        the same values for the same seed.
+        """
+        cumulative: np.ndarray = policy_cumulative(self.policy, self.grid_size * self.grid_size)
+        terminal_action = np.array(self.terminal_action, dtype=np.int64)
+
+        visits = np.zeros(self.grid_size * self.grid_size, dtype=np.int64)
+        visited = np.zeros(self.grid_size * self.grid_size, dtype=bool)
+
+        for n in range(num_episodes):
+            total_reward, num_steps, is_truncated = run_sarsa_episode(
+                values, self.action_mask, self.neighbour_states, self.neighbour_rewards, self.neighbour_terminal, terminal_action,
+                cumulative, self.state, alpha_factor, gamma_factor, epsilon_factor, max_steps, self.uniforms, visits, visited)
+
+            self.total_rewards.append(total_reward)
+            self.num_truncated += is_truncated
+
+            if monitor is not None and monitor.update(lambda: self.greedy_actions(values), values):
+                self.stopped_episode = n + 1
+                break
+
+        self.total_state_visits.update(enumerate(visits.tolist()))
+
     # Selects an optimal or random action based on epsilon greedy.
-    def epsilon_greedy(self, state_values: dict[(int, int), float], pos: tuple[int, int], epsilon: float = 0.3) -> tuple[int, int]:
+    def epsilon_greedy(self, state_values: np.ndarray, pos: int, epsilon: float = 0.3) -> int:
         # Get a random probability between 0 and 1.
-        p = random.uniform(0, 1)
+        p = self.uniforms.uniform()
         # If the probability is smaller than epsilon, take a random move.
         if p < epsilon:
-            action: tuple[int, int] = sample_policy_action(self.policy, pos)
+            action: int = sample_policy_action(self.policy, pos, self.uniforms)
         else:
-            eval_actions: dict[(int, int), float] = {}
-
-            # Select the optimal move.
-            for a in self.policy[pos]:
-                # Create the new position based on the action and the current position.
-                next_state: Observation = self.grid_action_cb(pos, a)
-
-                # If an action leads to a terminal state, return it as the optimal action.
-                if (next_state.is_terminal):
-                    return a
-
-                next_reward: float = state_values[next_state.grid_pos]
-                eval_actions[a] = next_reward
+            # If an action leads to a terminal state, return it as the optimal action.
+            if self.terminal_action[pos] >= 0:
+                return self.terminal_action[pos]
 
             # Get the best actions of the current state, based on the highest value associated.
-            best_actions: list[(int, int)] = [action for action, reward in eval_actions.items() if
-                                              reward == max(eval_actions.values())]
+            best_actions = self.best_actions(state_values, pos)
             # Choose a random action out of the best actions.
-            action = random.choice(best_actions)
+            action = int(best_actions[self.uniforms.integer(len(best_actions))])
         return action
 
+    def is_greedy(self, state_values: np.ndarray, pos: int, action: int) -> bool:
+        """Whether epsilon_greedy could have chosen the action without exploring."""
+        if self.terminal_action[pos] >= 0:
+            return action == self.terminal_action[pos]
+
+        return action in self.best_actions(state_values, pos)
+
     # Runs TD(0) and returns a list of state values.
     def td_zero(self, alpha: int = 1, gamma: float = 0.8, num_episodes: int = 100):
         # Create a dictionary with all cells of the grid, having a value of 0.
-        state_values: dict[tuple[int, int], float] = dict()
+        state_values: dict[int, float] = dict()
 
         # Initialize value table to all 0.0
-        for x in range(self.grid_size):
-            for y in range(self.grid_size):
-                state_values[(x,y)] = 0.0
-                self.total_state_visits[(x,y)] = 0
-
-                for action in self.policy[(x,y)].keys():
-                    self.q_table[(x,y)][action] = 0.0
+        for s in range(self.grid_size * self.grid_size):
+            state_values[s] = 0.0
+            self.total_state_visits[s] = 0
 
-        current_pos = self.grid_pos
+        current_pos = self.state
 
         # Iterate based on the number of episodes.
         for n in range(num_episodes):
-            episode: list[tuple[tuple[int, int], int], tuple[int, int]] = generate_episode(self, current_pos)
+            episode: list[tuple[int, int, float]] = generate_episode(self.policy, self.grid_action_cb, current_pos, uniforms=self.uniforms)
 
             # Iterate for each step taken in the episode.
             for step in episode:
@@ -169,8 +272,8 @@ class TDSarsaAlgorithm(Algorithm):
                 new_reward = new_pos.reward
 
                 # Update the state values.
-                state_values[current_pos] += alpha * (new_reward + gamma * state_values[new_pos.grid_pos] - state_values[current_pos])
-                current_pos = new_pos.grid_pos
+                state_values[current_pos] += alpha * (new_reward + gamma * state_values[new_pos.state] - state_values[current_pos])
+                current_pos = new_pos.state
 
             # Break if the state is terminal.
             if new_pos.is_terminal:
@@ -1,70 +1,435 @@
 import random
+from itertools import chain
 from typing import Callable
 from typing import NamedTuple
 
 import matplotlib.pyplot as plt
+import numpy as np
 import random
 
-from math_utils import tuple_addition
+from algorithms.policy import Policy
+from math_utils import ACTIONS
 
 class Observation(NamedTuple):
-    grid_pos: tuple[int, int]
+    # Flat state id (s = y * grid_size + x), see math_utils.encode_state.
+    state: int
     reward: float
     is_terminal: bool = False
+    # Whether the episode was cut off by a step limit (Gymnasium's "truncated"), the state itself is not terminal.
+    is_truncated: bool = False
 
-def sample_policy_action(policy: dict[tuple[int, int], dict[tuple[int, int]]], grid_pos: tuple[int, int]):
-    num = random.uniform(0, 1)
+class VectorObservation(NamedTuple):
+    # States reached by each agent, shape (N,).
+    states: np.ndarray
+    rewards: np.ndarray
+    is_terminal: np.ndarray
+    # Whether each agent's episode was cut off by the step limit.
+    is_truncated: np.ndarray
+    # States the agents continue from: agents that reached a terminal state or were truncated are reset to the start state.
+    reset_states: np.ndarray
+
+class TransitionModel(NamedTuple):
+    # Flat state index of the successor of each (state, action) pair, shape (S, A).
+    next_state: np.ndarray
+    # Reward received for each (state, action) pair, shape (S, A).
+    reward: np.ndarray
+    # Whether each state is terminal, shape (S,).
+    terminal: np.ndarray
+
+def build_transition_model(grid_action_cb: Callable[[int, int], Observation], num_states: int) -> TransitionModel:
+    """Builds the transition tables by querying the model callback once for every state-action pair."""
+    next_state = np.empty((num_states, len(ACTIONS)), dtype=np.int64)
+    reward = np.empty((num_states, len(ACTIONS)))
+    terminal = np.empty(num_states, dtype=bool)
+
+    for s in range(num_states):
+        terminal[s] = grid_action_cb(s).is_terminal
+
+        for a in range(len(ACTIONS)):
+            obs: Observation = grid_action_cb(s, a)
+            next_state[s, a] = obs.state
+            reward[s, a] = obs.reward
+
+    return TransitionModel(next_state, reward, terminal)
+
+def policy_action_mask(policy: dict[int, dict[int, float]], num_states: int) -> np.ndarray:
+    """Boolean (S, A) mask of the actions available to each state in the policy."""
+    mask = np.zeros((num_states, len(ACTIONS)), dtype=bool)
+
+    counts = [len(policy[s]) for s in range(num_states)]
+    actions = list(chain.from_iterable(policy[s] for s in range(num_states)))
+    mask[np.repeat(np.arange(num_states), counts), actions] = True
+
+    return mask
+
+def valid_action_mask(model: TransitionModel) -> np.ndarray:
+    """Boolean (S, A) mask of the actions that move the agent, i.e. that do not bump into the edge or a solid."""
+    return model.next_state != np.arange(len(model.next_state))[:, None]
+
+def policy_matrix(policy: dict[int, dict[int, float]], num_states: int) -> np.ndarray:
+    """Dense (S, A) matrix of the action probabilities of the policy."""
+    if isinstance(policy, Policy):
+        policy.refresh()
+        return policy.probabilities.copy()
+
+    probs = np.zeros((num_states, len(ACTIONS)))
+
+    counts = [len(policy[s]) for s in range(num_states)]
+    actions = list(chain.from_iterable(policy[s].keys() for s in range(num_states)))
+    probs[np.repeat(np.arange(num_states), counts), actions] = list(chain.from_iterable(policy[s].values() for s in range(num_states)))
+
+    return probs
+
+def reverse_transitions(next_state: np.ndarray, mask: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Index of the predecessors of every state, over the valid actions in the mask.
+    The predecessors of state s are predecessors[indptr[s]:indptr[s + 1]].
+    """
+    num_states: int = next_state.shape[0]
+
+    sources = np.repeat(np.arange(num_states), next_state.shape[1])[mask.ravel()]
+    targets = next_state.ravel()[mask.ravel()]
+
+    order = np.argsort(targets, kind="stable")
+    indptr = np.zeros(num_states + 1, dtype=np.int64)
+    np.cumsum(np.bincount(targets, minlength=num_states), out=indptr[1:])
+
+    return indptr, sources[order]
+
+class UniformStream:
+    """Uniform samples in [0, 1) from a numpy Generator. They are drawn in blocks and handed out one at a time,
+    as drawing single samples from a Generator costs more than the rest of a typical step.
+    The samples only depend on the state of the Generator, so a seeded stream is reproducible.
+    """
+    def __init__(self, rng: np.random.Generator, block_size: int = 4096):
+        self.rng: np.random.Generator = rng
+        self.block_size: int = block_size
+        self.block: list[float] = []
+        # The same block as an array, see upcoming.
+        self.block_array: np.ndarray = np.zeros(0)
+        self.index: int = 0
+
+    def uniform(self) -> float:
+        if self.index == len(self.block):
+            self.block_array = self.rng.random(self.block_size)
+            self.block = self.block_array.tolist()
+            self.index = 0
+
+        self.index += 1
+        return self.block[self.index - 1]
+
+    def integer(self, n: int) -> int:
+        """Uniform integer in [0, n)."""
+        return min(int(self.uniform() * n), n - 1)
+
+    def upcoming(self, count: int) -> np.ndarray:
+        """At least count of the next samples as an array, for code that consumes them in bulk. They stay next in
+        line until they are skipped.
+        """
+        while len(self.block) - self.index < count:
+            self.block_array = np.concatenate((self.block_array[self.index:], self.rng.random(self.block_size)))
+            self.block = self.block_array.tolist()
+            self.index = 0
+
+        return self.block_array[self.index:]
+
+    def skip(self, count: int) -> None:
+        """Marks the next count samples as used."""
+        self.index += count
+
+def sample_policy_action(policy: dict[int, dict[int, float]], state: int, uniforms: UniformStream = None) -> int:
+    # Without a stream of uniforms the global random module is used.
+    num = random.uniform(0, 1) if uniforms is None else uniforms.uniform()
+
+    # A compiled policy samples from its cumulative probabilities.
+    if isinstance(policy, Policy):
+        return policy.sample(state, num)
+
+    num *= sum(policy[state].values())
     threshold = 0.0
 
-    for act, prob in policy[grid_pos].items():
+    for act, prob in policy[state].items():
         threshold += prob
-        if num <= threshold:
+        if num < threshold:
             return act
 
-    assert("Something is wrong with the agent's policy!")
-    return None
+    raise ValueError("The policy of state {} has no action with a positive probability".format(state))
+
+class ReplayBuffer:
+    """Fixed-capacity store of transitions (state, action, reward, next state, terminal) in NumPy arrays, used as a
+    ring: once full, a new transition overwrites the oldest one. Adding is O(1), sampling a batch is a single gather.
+    """
+    def __init__(self, capacity: int):
+        self.capacity: int = capacity
+        self.states: np.ndarray = np.zeros(capacity, dtype=np.intp)
+        self.actions: np.ndarray = np.zeros(capacity, dtype=np.intp)
+        self.rewards: np.ndarray = np.zeros(capacity)
+        self.next_states: np.ndarray = np.zeros(capacity, dtype=np.intp)
+        self.terminals: np.ndarray = np.zeros(capacity, dtype=bool)
+
+        self.index: int = 0 # Where the next transition is stored.
+        self.size: int = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, state: int, action: int, reward: float, next_state: int, is_terminal: bool) -> None:
+        self.states[self.index] = state
+        self.actions[self.index] = action
+        self.rewards[self.index] = reward
+        self.next_states[self.index] = next_state
+        self.terminals[self.index] = is_terminal
+
+        self.index = (self.index + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def sample(self, batch_size: int, rng: np.random.Generator) -> tuple[np.ndarray, ...]:
+        """A batch of stored transitions, drawn uniformly with replacement: (states, actions, rewards, next states, terminals)."""
+        batch = rng.integers(self.size, size=batch_size)
+
+        return self.states[batch], self.actions[batch], self.rewards[batch], self.next_states[batch], self.terminals[batch]
+
+class LearnedModel:
+    """A deterministic model learned from experience: the last observed reward, next state and terminal flag of every
+    visited state-action pair, shape (S, A). Sampling draws uniformly from the pairs seen so far, in the same form as
+    ReplayBuffer.sample, so planning can use either.
+    """
+    def __init__(self, num_states: int, num_actions: int):
+        self.num_actions: int = num_actions
+        self.rewards: np.ndarray = np.zeros((num_states, num_actions))
+        self.next_states: np.ndarray = np.zeros((num_states, num_actions), dtype=np.intp)
+        self.terminals: np.ndarray = np.zeros((num_states, num_actions), dtype=bool)
+        self.known: np.ndarray = np.zeros((num_states, num_actions), dtype=bool)
+
+        # The seen pairs as s * A + a, in order of their first visit.
+        self.pairs: np.ndarray = np.zeros(num_states * num_actions, dtype=np.intp)
+        self.size: int = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, state: int, action: int, reward: float, next_state: int, is_terminal: bool) -> None:
+        if not self.known[state, action]:
+            self.known[state, action] = True
+            self.pairs[self.size] = state * self.num_actions + action
+            self.size += 1
+
+        self.rewards[state, action] = reward
+        self.next_states[state, action] = next_state
+        self.terminals[state, action] = is_terminal
+
+    def sample(self, batch_size: int, rng: np.random.Generator) -> tuple[np.ndarray, ...]:
+        """A batch of seen pairs with their modelled outcome: (states, actions, rewards, next states, terminals)."""
+        states, actions = np.divmod(self.pairs[rng.integers(self.size, size=batch_size)], self.num_actions)
+
+        return states, actions, self.rewards[states, actions], self.next_states[states, actions], self.terminals[states, actions]
+
+class VisitCounter:
+    """Counts in how many episodes each state was visited, for episodes that run at the same time. Visits are kept as
+    episode * S + state keys and only deduplicated (np.unique) and counted in batches, for the episodes that finished,
+    so that the cost follows the number of steps taken instead of the size of the grid.
+    """
+    def __init__(self, num_states: int, flush_size: int = 1 << 16):
+        self.num_states: int = num_states
+        # Number of finished episodes in which each state was visited.
+        self.visits: np.ndarray = np.zeros(num_states, dtype=np.int64)
+
+        # Keys added since the last flush, and the keys of episodes that were still running at the last flush.
+        self.keys: list[np.ndarray] = []
+        self.num_keys: int = 0
+        self.flush_size: int = flush_size
+
+    def add(self, episodes: np.ndarray, states: np.ndarray) -> None:
+        keys = episodes * self.num_states + states
+        self.keys.append(keys)
+        self.num_keys += len(keys)
 
-def generate_episode(policy: dict[tuple[int, int], dict[tuple[int, int]]], grid_action_cb: Callable[[tuple[int, int], tuple[int, int]], Observation],
-                     grid_pos: tuple[int, int]) -> list[tuple[tuple[int, int], int], tuple[int, int]]:
-    episode: list[tuple[tuple[int, int], int], tuple[int, int]] = list()
+    def flush(self, finished: np.ndarray, force: bool = False) -> None:
+        """Counts the visits of the finished episodes (a bool per episode id), once enough keys were added or when forced."""
+        if not self.keys or (self.num_keys < self.flush_size and not force):
+            return
 
-    state = grid_pos
+        keys = np.unique(np.concatenate(self.keys))
+        ended = finished[keys // self.num_states]
+        np.add.at(self.visits, keys[ended] % self.num_states, 1)
+
+        self.keys = [keys[~ended]]
+        self.num_keys = len(self.keys[0])
+
+        # The keys of the running episodes stay, flush again once at least as many new ones came in.
+        self.flush_size = max(self.flush_size, 2 * self.num_keys)
+
+class ConvergenceMonitor:
+    """Decides when a learning run can stop: when the greedy policy has not changed for patience episodes, or when no
+    value has changed by tolerance or more over window episodes. Either criterion is off when it is None.
+    The tables are only compared every window episodes, so that watching a run costs O(S * A) per window instead of
+    per episode.
+    """
+    def __init__(self, patience: int = None, tolerance: float = None, window: int = 10):
+        self.patience: int = patience
+        self.tolerance: float = tolerance
+        self.window: int = window
+
+        # Greedy actions and values at the previous comparison.
+        self.greedy: np.ndarray = None
+        self.values: np.ndarray = None
+
+        # Episodes since the previous comparison.
+        self.num_pending: int = 0
+
+        # Number of episodes in a row without a change of the greedy policy, and with all value changes below tolerance.
+        self.num_unchanged: int = 0
+        self.num_settled: int = 0
+
+    def update(self, greedy_cb: Callable[[], np.ndarray], values: np.ndarray, num_episodes: int = 1) -> bool:
+        """Records that num_episodes more episodes ran, returns whether the run converged. Once window episodes
+        have run since the previous comparison, the greedy actions (computed by greedy_cb) and the values are compared
+        to the ones of then.
+        """
+        self.num_pending += num_episodes
+        if self.greedy is not None and self.num_pending < self.window:
+            return False
+
+        greedy = greedy_cb()
+        if self.greedy is not None:
+            self.num_unchanged = self.num_unchanged + self.num_pending if np.array_equal(greedy, self.greedy) else 0
+
+            # Equal values have no change, also when both are infinite.
+            changes = np.abs(np.subtract(values, self.values, out=np.zeros(values.shape), where=values != self.values))
+            self.num_settled = self.num_settled + self.num_pending if self.tolerance is not None and changes.max(initial=0.0) < self.tolerance else 0
+
+        self.greedy = greedy.copy()
+        self.values = values.copy()
+        self.num_pending = 0
+
+        return ((self.patience is not None and self.num_unchanged >= self.patience) or
+                (self.tolerance is not None and self.num_settled >= self.window))
+
+def visit_trace(traces: dict[int, float], key: int, kind: str) -> None:
+    """Marks a visit in sparse eligibility traces: "accumulating" traces add 1, "replacing" traces are set to 1."""
+    traces[key] = traces.get(key, 0.0) + 1.0 if kind == "accumulating" else 1.0
+
+def decay_traces(traces: dict[int, float], factor: float, cutoff: float) -> dict[int, float]:
+    """Decays sparse eligibility traces by the factor. Entries that fall below the cutoff are dropped, so that only
+    the recently visited keys are kept and the cost of a step stays bounded.
+    """
+    return {key: trace * factor for key, trace in traces.items() if trace * factor >= cutoff}
+
+def generate_episode(policy: dict[int, dict[int, float]], grid_action_cb: Callable[[int, int], Observation],
+                     state: int, max_steps: int = None, uniforms: UniformStream = None) -> list[tuple[int, int, float]]:
+    """Follows the policy from the state until a terminal state is reached, or until max_steps steps were taken."""
+    episode: list[tuple[int, int, float]] = list()
 
     while (True):
-        act = sample_policy_action(policy, state)
-        next_state = tuple_addition(state, act)
+        act = sample_policy_action(policy, state, uniforms)
 
         obs = grid_action_cb(state, act)
         episode.append((state, act, obs.reward))
 
-        if (obs.is_terminal):
+        if (obs.is_terminal or len(episode) == max_steps):
             break
 
-        state = next_state  
+        state = obs.state
 
     return episode
 
-from cell import Cell
-
-
-def init_policy(grid: dict[tuple[int, int], Cell], grid_size: int, movement: dict[tuple[int, int], dict[tuple[int, int], float]]) -> None:
-    for x in range(0, grid_size):
-        for y in range(0, grid_size):
-            movement[(x, y)] = dict()
-            if x > 0:
-                add_action(grid, movement, (x, y), (-1, 0))
-            if x < grid_size - 1:
-                add_action(grid, movement, (x, y), (1, 0))
-            if y > 0:
-                add_action(grid, movement, (x, y), (0, -1))
-            if y < grid_size - 1:
-                add_action(grid, movement, (x, y), (0, 1))
-
-            probability: float = 1 / len(movement[(x, y)])
-            for key in movement[(x, y)]:
-                movement[(x, y)][key] = probability
-
-def add_action(grid, movement, position, action) -> None:
-    new_pos = (position[0] + action[0], position[1] + action[1])
-    if not grid[new_pos].is_solid:
-        movement[position][action] = 0
+class EpisodeBuffer:
+    """The states, actions and rewards of an episode, in arrays that grow as needed and are reused between episodes."""
+    def __init__(self, capacity: int = 256):
+        self.states: np.ndarray = np.empty(capacity, dtype=np.int64)
+        self.actions: np.ndarray = np.empty(capacity, dtype=np.int64)
+        self.rewards: np.ndarray = np.empty(capacity)
+        self.length: int = 0
+        # Whether the episode ended at the step limit instead of in a terminal state.
+        self.is_truncated: bool = False
+
+    def __len__(self) -> int:
+        return self.length
+
+    def clear(self) -> None:
+        self.length = 0
+        self.is_truncated = False
+
+    def grow(self) -> None:
+        # Double the capacity, so that appending stays O(1) on average.
+        self.states = np.concatenate((self.states, np.empty_like(self.states)))
+        self.actions = np.concatenate((self.actions, np.empty_like(self.actions)))
+        self.rewards = np.concatenate((self.rewards, np.empty_like(self.rewards)))
+
+    def append(self, state: int, action: int, reward: float) -> None:
+        if self.length == len(self.states):
+            self.grow()
+
+        self.states[self.length] = state
+        self.actions[self.length] = action
+        self.rewards[self.length] = reward
+        self.length += 1
+
+    def extend(self, states: np.ndarray, actions: np.ndarray, rewards: np.ndarray) -> None:
+        """Appends a number of steps at once."""
+        end: int = self.length + len(states)
+
+        if end > len(self.states):
+            capacity: int = max(end, 2 * len(self.states))
+            self.states = np.concatenate((self.states[:self.length], np.empty(capacity - self.length, dtype=self.states.dtype)))
+            self.actions = np.concatenate((self.actions[:self.length], np.empty(capacity - self.length, dtype=self.actions.dtype)))
+            self.rewards = np.concatenate((self.rewards[:self.length], np.empty(capacity - self.length)))
+
+        self.states[self.length:end] = states
+        self.actions[self.length:end] = actions
+        self.rewards[self.length:end] = rewards
+        self.length = end
+
+    def returns(self, gamma: float) -> np.ndarray:
+        """The discounted return of every step, G_t = r_t + gamma * G_t+1, without a Python loop over the steps.
+        Within a block, G_t = sum_k gamma^k r_k / gamma^t over the remaining steps of the block, a reversed cumulative sum.
+        Blocks are short enough for gamma^-t not to overflow, and each block adds the discounted return of the next block.
+        """
+        rewards: np.ndarray = self.rewards[:self.length]
+        returns: np.ndarray = np.empty(self.length)
+
+        if gamma <= 0.0:
+            returns[:] = rewards
+            return returns
+
+        block_size: int = self.length if gamma >= 1.0 else max(1, int(np.log(1e100) / -np.log(gamma)))
+        next_return: float = 0.0
+
+        for start in range(((self.length - 1) // block_size) * block_size, -1, -block_size):
+            end: int = min(start + block_size, self.length)
+            discounts: np.ndarray = gamma ** np.arange(end - start + 1, dtype=float)
+
+            block: np.ndarray = np.cumsum((rewards[start:end] * discounts[:-1])[::-1])[::-1] / discounts[:-1]
+            returns[start:end] = block + discounts[-1] / discounts[:-1] * next_return
+            next_return = returns[start]
+
+        return returns
+
+    def first_visits(self) -> np.ndarray:
+        """Boolean mask of the steps at which their state-action pair is visited for the first time in the episode."""
+        pairs: np.ndarray = self.states[:self.length] * len(ACTIONS) + self.actions[:self.length]
+        mask: np.ndarray = np.zeros(self.length, dtype=bool)
+        mask[np.unique(pairs, return_index=True)[1]] = True
+
+        return mask
+
+def generate_episode_buffer(policy: dict[int, dict[int, float]], grid_action_cb: Callable[[int, int], Observation],
+                            state: int, buffer: EpisodeBuffer, max_steps: int = None, uniforms: UniformStream = None) -> EpisodeBuffer:
+    """Like generate_episode, but records the episode into the (cleared) buffer."""
+    buffer.clear()
+
+    while (True):
+        act = sample_policy_action(policy, state, uniforms)
+
+        obs = grid_action_cb(state, act)
+        buffer.append(state, act, obs.reward)
+
+        if (obs.is_terminal):
+            break
+
+        if (len(buffer) == max_steps):
+            buffer.is_truncated = True
+            break
+
+        state = obs.state
+
+    return buffer
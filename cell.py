@@ -1,7 +1,102 @@
+import numpy as np
+
+from math_utils import encode_state
+
+class Grid:
+    """The squares of a square grid, stored as parallel arrays indexed by flat state id (s = y * grid_size + x).
+    Indexing with a grid position returns a Cell view over that square.
+    """
+    def __init__(self, grid_size: int, base_reward: float = 0.0):
+        self.grid_size: int = grid_size
+
+        num_squares: int = grid_size * grid_size
+        self.reward: np.ndarray = np.full(num_squares, base_reward, dtype=np.float32)
+        self.solid: np.ndarray = np.zeros(num_squares, dtype=bool)
+        self.terminal: np.ndarray = np.zeros(num_squares, dtype=bool)
+        self.sprite: np.ndarray = np.zeros(num_squares, dtype=np.uint8)
+
+        # Image file of each sprite id, id 0 is "no image".
+        self.sprites: list[str] = [None]
+
+        # Incremented on every change of the rewards, solids or terminals, so that the transition tables
+        # derived from the grid know when to rebuild. Sprites are only drawn and do not count as a change.
+        self.version: int = 0
+
+    def sprite_id(self, img: str) -> int:
+        if img not in self.sprites:
+            if len(self.sprites) > np.iinfo(self.sprite.dtype).max:
+                raise ValueError("Too many different sprites in the grid")
+
+            self.sprites.append(img)
+
+        return self.sprites.index(img)
+
+    def __getitem__(self, grid_pos: tuple[int, int]) -> "Cell":
+        return Cell.view(self, grid_pos)
+
+    def __setitem__(self, grid_pos: tuple[int, int], cell: "Cell") -> None:
+        s: int = encode_state(grid_pos, self.grid_size)
+
+        self.reward[s] = cell.reward
+        self.solid[s] = cell.is_solid
+        self.terminal[s] = cell.is_terminal
+        self.sprite[s] = self.sprite_id(cell.img)
+        self.version += 1
+
 class Cell:
+    """A single square of a Grid. A Cell created on its own is backed by a grid of one square."""
+    __slots__ = ("grid_pos", "_grid", "_s")
+
     def __init__(self, grid_pos, reward, img = None, is_terminal = False, is_solid = False):
         self.grid_pos = grid_pos
+        self._grid: Grid = Grid(1)
+        self._s: int = 0
+
         self.reward = reward
         self.img = img
-        self.is_terminal = is_terminal 
-        self.is_solid = is_solid
\ No newline at end of file
+        self.is_terminal = is_terminal
+        self.is_solid = is_solid
+
+    @classmethod
+    def view(cls, grid: Grid, grid_pos: tuple[int, int]) -> "Cell":
+        cell = cls.__new__(cls)
+        cell.grid_pos = grid_pos
+        cell._grid = grid
+        cell._s = encode_state(grid_pos, grid.grid_size)
+
+        return cell
+
+    @property
+    def reward(self) -> float:
+        return float(self._grid.reward[self._s])
+
+    @reward.setter
+    def reward(self, reward: float) -> None:
+        self._grid.reward[self._s] = reward
+        self._grid.version += 1
+
+    @property
+    def img(self) -> str:
+        return self._grid.sprites[self._grid.sprite[self._s]]
+
+    @img.setter
+    def img(self, img: str) -> None:
+        self._grid.sprite[self._s] = self._grid.sprite_id(img)
+
+    @property
+    def is_terminal(self) -> bool:
+        return bool(self._grid.terminal[self._s])
+
+    @is_terminal.setter
+    def is_terminal(self, is_terminal: bool) -> None:
+        self._grid.terminal[self._s] = is_terminal
+        self._grid.version += 1
+
+    @property
+    def is_solid(self) -> bool:
+        return bool(self._grid.solid[self._s])
+
+    @is_solid.setter
+    def is_solid(self, is_solid: bool) -> None:
+        self._grid.solid[self._s] = is_solid
+        self._grid.version += 1
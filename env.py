@@ -1,18 +1,23 @@
 import gymnasium as gym
 import numpy as np
-from cell import Cell
-import math_utils
+from cell import Cell, Grid
+from math_utils import ACTIONS, decode_state, encode_state
 
-from algorithms.utils import Observation
+from algorithms.utils import Observation, TransitionModel, VectorObservation
 
 class SchoolEnv(gym.Env):
-    def __init__(self, agent_location: tuple[int, int], target: Cell, grid_size = 5):
+    def __init__(self, agent_location: tuple[int, int], target: Cell, grid_size = 5, max_steps: int = None):
         super(SchoolEnv, self).__init__()
 
         self.grid_size = grid_size  # The size of the square grid
 
-        self.agent_location: tuple[int, int] = agent_location
-        self.agent_reset_location: tuple[int, int] = agent_location
+        # Episodes are truncated after max_steps steps of the agent (None for no limit).
+        self.max_steps: int = max_steps
+        self.elapsed_steps: int = 0
+
+        # The agent's state is kept as a flat state id (s = y * grid_size + x).
+        self.agent_state: int = encode_state(agent_location, grid_size)
+        self.agent_reset_state: int = self.agent_state
 
         # Locations of the solids, primarily for visualization.
         self.solids: list[tuple[int, int]] = []
@@ -27,10 +32,23 @@ class SchoolEnv(gym.Env):
         # Base reward for moving to an empty Cell in the grid.
         self.base_reward: float = -1.0
 
-        # Dictionary of the grid mapping coordinates to Cells.
-        self.grid: dict[tuple[int, int], Cell] = {}
+        # The grid, stored as parallel arrays. Indexing it with coordinates returns a Cell view.
+        self.grid: Grid = None
         self.init_grid() # Creates a grid with empty Cells.
 
+        # Transition tables compiled from the grid, indexed by the flat state s = y * grid_size + x.
+        # They are (re)built by compile() whenever the grid changed since the last compile.
+        self.compiled_version: int = -1
+        self.next_state: np.ndarray = None    # (S, A) successor state of each state-action pair.
+        self.reward: np.ndarray = None        # (S, A) reward of each state-action pair.
+        self.terminal: np.ndarray = None      # (S,) whether a state is terminal.
+        self.state_reward: np.ndarray = None  # (S,) reward of the Cell at each state.
+
+    @property
+    def agent_location(self) -> tuple[int, int]:
+        """Grid position (x, y) of the agent, for visualization."""
+        return decode_state(self.agent_state, self.grid_size)
+
     def register_object(self, cell: Cell) -> None:
         if cell.is_solid:
             # Register the grid position of a solid for visualization.
@@ -44,50 +62,207 @@ class SchoolEnv(gym.Env):
         self.grid[cell.grid_pos] = cell
 
     def init_grid(self) -> None:
-        for x in range(self.grid_size):
-            for y in range(self.grid_size):
-                self.grid[(x, y)] = Cell((x, y), self.base_reward)
+        self.grid = Grid(self.grid_size, self.base_reward)
 
         self.grid[self.target.grid_pos] = self.target
 
     def reset(self, seed = None, options = None):
-        """Reset the environment to an initial state."""
-        self.agent_location = self.agent_reset_location
-        self.reward_locations = self.reward_reset_locations
+        """Reset the environment to an initial state. A seed restarts np_random, which the agent's random generator can be taken from."""
+        super().reset(seed = seed)
+
+        self.agent_state = self.agent_reset_state
+        self.reward_locations = dict(self.reward_reset_locations)
+        self.elapsed_steps = 0
 
         return self.get_obs()
     
-    def step(self, action: tuple[int, int], state: tuple[int, int] = None) -> Observation:
-        if (state is None):
-            backup_state = self.agent_location
-        else:
-            backup_state = state
-        
-        backup_state = (self.agent_location) if state is None else state
-        temp_state = (self.agent_location) if state is None else state
-        temp_state = np.array(temp_state) + np.array(action)
-        temp_state = np.clip(temp_state, 0, self.grid_size - 1)
-        temp_state = math_utils.np_to_tuple(temp_state)
+    def compile(self) -> None:
+        """Compile the grid into flat transition tables, so that a model lookup is a single array index."""
+        num_states: int = self.grid_size * self.grid_size
+
+        states = np.arange(num_states, dtype=np.int32 if num_states <= np.iinfo(np.int32).max else np.int64)
+        next_state = self.compile_transitions(states)
+
+        self.next_state = next_state
+        self.reward = self.grid.reward[next_state]
+        self.terminal = self.grid.terminal.copy()
+        self.state_reward = self.grid.reward.copy()
+        self.compiled_version = self.grid.version
+
+    def compile_transitions(self, states: np.ndarray) -> np.ndarray:
+        """The successor of every action from each of the given states, shape (len(states), A)."""
+        xs, ys = states % self.grid_size, states // self.grid_size
+
+        next_state = np.empty((len(states), len(ACTIONS)), dtype=states.dtype)
+        for a, (dx, dy) in enumerate(ACTIONS):
+            # Moves are clipped to the grid; moving into a solid leaves the agent where it was.
+            next_xs = np.clip(xs + dx, 0, self.grid_size - 1)
+            next_ys = np.clip(ys + dy, 0, self.grid_size - 1)
+            target_states = next_ys * self.grid_size + next_xs
+            next_state[:, a] = np.where(self.grid.solid[target_states], states, target_states)
 
-        cell: Cell = self.grid[temp_state]
+        return next_state
 
+    def update_cell(self, grid_pos: tuple[int, int], reward: float = None, img: str = None,
+                    is_terminal: bool = None, is_solid: bool = None) -> list[int]:
+        """Changes a single cell at runtime, e.g. to move a virus or to add a solid. Only the rows of the transition
+        tables that can be affected (the cell and its neighbours) are recompiled, in place.
+        Returns those states, so a planner can repair its solution locally (see Agent.replan).
+        """
+        if self.compiled_version != self.grid.version:
+            self.compile()
+
+        cell: Cell = self.grid[grid_pos]
+
+        if reward is not None:
+            cell.reward = reward
+        if img is not None:
+            cell.img = img
+        if is_terminal is not None:
+            cell.is_terminal = is_terminal
+        if is_solid is not None:
+            cell.is_solid = is_solid
+
+        # Keep the object bookkeeping for visualization up to date.
         if cell.is_solid:
-            temp_state = backup_state
-            cell: Cell = self.grid[temp_state]
+            if grid_pos not in self.solids:
+                self.solids.append(grid_pos)
+            self.reward_locations.pop(grid_pos, None)
+        else:
+            if grid_pos in self.solids:
+                self.solids.remove(grid_pos)
+            if cell.reward != self.base_reward or cell.is_terminal:
+                self.reward_locations[grid_pos] = cell.reward
+            else:
+                self.reward_locations.pop(grid_pos, None)
+
+        x, y = grid_pos
+        states: list[int] = [encode_state(pos, self.grid_size) for pos in ((x, y), (x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1))
+                             if 0 <= pos[0] < self.grid_size and 0 <= pos[1] < self.grid_size]
+
+        rows = np.array(states, dtype=self.next_state.dtype)
+        self.next_state[rows] = self.compile_transitions(rows)
+        self.reward[rows] = self.grid.reward[self.next_state[rows]]
+        self.terminal[rows] = self.grid.terminal[rows]
+        self.state_reward[rows] = self.grid.reward[rows]
+        self.compiled_version = self.grid.version
+
+        return states
+
+    def move_object(self, old_pos: tuple[int, int], new_pos: tuple[int, int]) -> list[int]:
+        """Moves a (non-solid) object, e.g. a virus, to another cell, leaving an empty cell behind.
+        Returns the states whose transitions changed, like update_cell.
+        """
+        cell: Cell = self.grid[old_pos]
+        reward, img, is_terminal = cell.reward, cell.img, cell.is_terminal
+
+        states: list[int] = self.update_cell(old_pos, self.base_reward, None, False)
+        self.grid[old_pos].img = None
+
+        for s in self.update_cell(new_pos, reward, img, is_terminal):
+            if s not in states:
+                states.append(s)
 
-        obs = Observation(temp_state, cell.reward, cell.is_terminal)
+        return states
 
+    def transition_model(self) -> TransitionModel:
+        """Returns the compiled transition tables of the grid, compiling them first if needed."""
+        if self.compiled_version != self.grid.version:
+            self.compile()
+
+        return TransitionModel(self.next_state, self.reward, self.terminal)
+
+    def step(self, action: int, state: int = None) -> Observation:
+        if self.compiled_version != self.grid.version:
+            self.compile()
+
+        s = self.agent_state if state is None else state
+        next_s = int(self.next_state[s, action])
+
+        # Only the agent's own steps count towards the step limit, model queries for other states do not.
+        truncated: bool = False
         if (state is None):
-            self.agent_location = temp_state
+            self.agent_state = next_s
+            self.elapsed_steps += 1
+            truncated = self.max_steps is not None and self.elapsed_steps >= self.max_steps
 
-        return obs
+        return Observation(next_s, float(self.reward[s, action]), bool(self.terminal[next_s]), truncated)
 
-    def get_obs(self, state: tuple[int, int] = None, action: tuple[int, int] = None) -> Observation:
+    def get_obs(self, state: int = None, action: int = None) -> Observation:
         if (action is None):
-            return Observation(self.agent_location if state is None else state, self.grid[self.agent_location].reward, self.grid[self.agent_location].is_terminal)
+            if self.compiled_version != self.grid.version:
+                self.compile()
+
+            s = self.agent_state if state is None else state
+
+            return Observation(s, float(self.state_reward[s]), bool(self.terminal[s]))
         else:
             return self.step(action, state)
 
     def close(self):
         """Clean up resources (optional)."""
-        pass
\ No newline at end of file
+        pass
+
+class VectorSchoolEnv:
+    """Steps a batch of agents through a SchoolEnv at once, using its compiled transition tables.
+    Agent positions are kept as flat states (s = y * grid_size + x), actions are indices into math_utils.ACTIONS.
+    """
+    def __init__(self, env: SchoolEnv, num_envs: int, max_steps: int = None):
+        self.env: SchoolEnv = env
+
+        # Episodes are truncated after max_steps steps, by default the step limit of the environment.
+        self.init_agents(env.transition_model(), env.agent_reset_state, env.grid_size, num_envs,
+                         env.max_steps if max_steps is None else max_steps)
+
+    @classmethod
+    def from_model(cls, model: TransitionModel, start_state: int, grid_size: int, num_envs: int,
+                   max_steps: int = None) -> "VectorSchoolEnv":
+        """Agents stepped through the given transition tables, without a SchoolEnv (e.g. inside an algorithm)."""
+        vector_env = cls.__new__(cls)
+        vector_env.env = None
+        vector_env.init_agents(model, start_state, grid_size, num_envs, max_steps)
+
+        return vector_env
+
+    def init_agents(self, model: TransitionModel, start_state: int, grid_size: int, num_envs: int, max_steps: int) -> None:
+        self.model: TransitionModel = model
+        self.start_state: int = start_state
+        self.grid_size: int = grid_size
+        self.num_envs: int = num_envs
+        self.max_steps: int = max_steps
+
+        # The current state of every agent.
+        self.states: np.ndarray = np.full(num_envs, self.start_state, dtype=np.intp)
+        # The number of steps of the current episode of every agent.
+        self.elapsed_steps: np.ndarray = np.zeros(num_envs, dtype=np.int64)
+
+    def reset(self, seed = None, options = None) -> np.ndarray:
+        """Reset all agents to the starting state."""
+        if self.env is not None:
+            self.model = self.env.transition_model()
+        self.states.fill(self.start_state)
+        self.elapsed_steps.fill(0)
+
+        return self.states.copy()
+
+    def step(self, actions: np.ndarray) -> VectorObservation:
+        next_states = self.model.next_state[self.states, actions]
+        rewards = self.model.reward[self.states, actions]
+        is_terminal = self.model.terminal[next_states]
+
+        self.elapsed_steps += 1
+        if self.max_steps is None:
+            is_truncated = np.zeros(self.num_envs, dtype=bool)
+        else:
+            is_truncated = self.elapsed_steps >= self.max_steps
+
+        # Agents that reached a terminal state or the step limit start a new episode right away.
+        done = is_terminal | is_truncated
+        self.states = np.where(done, self.start_state, next_states)
+        self.elapsed_steps[done] = 0
+
+        return VectorObservation(next_states, rewards, is_terminal, is_truncated, self.states.copy())
+
+    def grid_positions(self) -> list[tuple[int, int]]:
+        """The (x, y) grid position of every agent, for visualization."""
+        return [decode_state(s, self.grid_size) for s in self.states]
@@ -12,11 +12,12 @@ import gymnasium as gym
 import plot
 from disp import EnvRenderer
 from algorithms.utils import Observation
+from math_utils import encode_action
 
 # Configure the logger
 logging.basicConfig(level=logging.INFO, format='%(asctime)s: [%(levelname)s] %(message)s')
 
-def sim_step(env: gym.Env, agent: Agent, action: tuple[int, int] = None):
+def sim_step(env: gym.Env, agent: Agent, action: int = None):
     real_action = action
 
     if (action is None):
@@ -24,23 +25,23 @@ def sim_step(env: gym.Env, agent: Agent, action: tuple[int, int] = None):
 
     obs: Observation = env.step(real_action)
 
-    step_str: dict[tuple[int, int], str] = {
-        (-1, 0): "LEFT",
-        (1, 0): "RIGHT",
-        (0, -1): "UP",
-        (0, 1): "DOWN"
+    step_str: dict[int, str] = {
+        encode_action((-1, 0)): "LEFT",
+        encode_action((1, 0)): "RIGHT",
+        encode_action((0, -1)): "UP",
+        encode_action((0, 1)): "DOWN"
     }
 
-    agent.grid_pos = obs.grid_pos
+    agent.state = obs.state
 
     logging.info("[SIMULATION STEP, {}] Obtained reward: {}".format(step_str[real_action], obs.reward))
 
-    return obs.reward, obs.is_terminal
+    return obs.reward, obs.is_terminal or obs.is_truncated
 
 
 def sim_reset(env: gym.Env, agent: Agent):
     obs: Observation = env.reset()
-    agent.grid_pos = obs.grid_pos
+    agent.state = obs.state
 
     logging.info("[SIMULATION RESET]")
 
@@ -93,20 +94,26 @@ if __name__ == "__main__":
     for key, cell in env_objects.items():
         school_env.register_object(cell)
 
-    obs: Observation = school_env.reset()
+    # All objects are registered, compile the grid into its transition tables once.
+    school_env.compile()
 
-    agent = Agent(school_env.get_obs, agent_pos, grid_size)
+    seed = None # Set to an integer for reproducible runs
+
+    obs: Observation = school_env.reset(seed = seed)
+
+    agent = Agent(school_env.get_obs, agent_pos, grid_size, model_cb = school_env.transition_model, rng = school_env.np_random)
     rewards: dict = dict()
 
     # Default hyperparameters
     alpha_factor = 0.10
     gamma_factor = 0.90
     num_episodes = 200
-
-    agent.init_policy()
+    max_steps = 1000 # Episodes of the learning algorithms are truncated after this many steps
+    lambda_factor = 0.8 # Trace decay of the SARSA(λ) and Q(λ) curves in CUMU_REWARDS
+    planning_steps = 10 # Planning updates per step of the Dyna-Q curve in CUMU_REWARDS
 
     if (len(sys.argv) < 2):
-        print("Error: no algorithm given\n\t- Usage: python main.py <algorithm> (PI, VI, MC, SARSA, QLEARNING, CUMU_REWARDS)")
+        print("Error: no algorithm given\n\t- Usage: python main.py <algorithm> (PI, VI, SP, MC, SARSA, QLEARNING, LINEAR, CUMU_REWARDS)")
         sys.exit()
 
     # Parse input parameter
@@ -118,40 +125,82 @@ if __name__ == "__main__":
         agent.set_algorithm(AgentAlgorithm.VALUE_ITERATION)
         agent.run_algorithm(gamma_factor = gamma_factor, theta_factor = 0.001)
         plot.plot_vi_heatmap(grid_size, agent.algorithm.optimal_actions, agent.algorithm.potential_rewards)
+    elif (sys.argv[1] == "SP"):
+        # Solve with value iteration first, to check the shortest path solution against it.
+        agent.set_algorithm(AgentAlgorithm.VALUE_ITERATION)
+        agent.run_algorithm(gamma_factor = gamma_factor, theta_factor = 0.001)
+        vi_rewards = dict(agent.algorithm.potential_rewards)
+
+        agent.init_policy()
+        agent.set_algorithm(AgentAlgorithm.SHORTEST_PATH)
+        agent.run_algorithm(gamma_factor = gamma_factor, theta_factor = 0.001)
+
+        max_deviation = max(abs(agent.algorithm.potential_rewards[s] - vi_rewards[s]) for s in vi_rewards)
+        logging.info("Shortest path: {} states expanded, max. deviation from value iteration: {:.6f}".format(agent.algorithm.num_expansions, max_deviation))
+        plot.plot_vi_heatmap(grid_size, agent.algorithm.optimal_actions, agent.algorithm.potential_rewards)
     elif (sys.argv[1] == "MC"):
         agent.set_algorithm(AgentAlgorithm.MONTE_CARLO)
-        agent.run_algorithm(gamma_factor = gamma_factor, num_episodes = num_episodes, epsilon_mod = 0.05)
+        agent.run_algorithm(gamma_factor = gamma_factor, num_episodes = num_episodes, epsilon_mod = 0.05, max_steps = max_steps)
         rewards["Monte Carlo"] = agent.algorithm.total_rewards
+        logging.info("Monte Carlo: {} of {} episodes truncated at {} steps".format(agent.algorithm.num_truncated, num_episodes, max_steps))
         plot.plot_state_visits(agent.algorithm.total_state_visits, grid_size, num_episodes, "Monte Carlo total state visits (normalized)")
     elif (sys.argv[1] == "SARSA"):
         agent.set_algorithm(AgentAlgorithm.SARSA)
-        agent.run_algorithm(alpha_factor = alpha_factor, gamma_factor = gamma_factor, epsilon_factor = 0.05, num_episodes = num_episodes)
+        agent.run_algorithm(alpha_factor = alpha_factor, gamma_factor = gamma_factor, epsilon_factor = 0.05, num_episodes = num_episodes, max_steps = max_steps)
         rewards["SARSA"] = agent.algorithm.total_rewards
+        logging.info("SARSA: {} of {} episodes truncated at {} steps".format(agent.algorithm.num_truncated, num_episodes, max_steps))
         plot.plot_sarsa_heatmap(grid_size, agent.policy, agent.algorithm.state_values)
         plot.plot_state_visits(agent.algorithm.total_state_visits, grid_size, num_episodes, "SARSA total state visits (normalized)")
     elif (sys.argv[1] == "QLEARNING"):
         agent.set_algorithm(AgentAlgorithm.Q_LEARNING)
-        agent.run_algorithm(alpha_factor = alpha_factor, gamma_factor = gamma_factor, num_episodes = num_episodes)
+        agent.run_algorithm(alpha_factor = alpha_factor, gamma_factor = gamma_factor, num_episodes = num_episodes, max_steps = max_steps)
         rewards["Q-Learning"] = agent.algorithm.total_rewards
+        logging.info("Q-Learning: {} of {} episodes truncated at {} steps".format(agent.algorithm.num_truncated, num_episodes, max_steps))
         plot.plot_state_visits(agent.algorithm.total_state_visits, grid_size, num_episodes, "Q-Learning total state visits (normalized)")
+    elif (sys.argv[1] == "LINEAR"):
+        agent.set_algorithm(AgentAlgorithm.LINEAR_TD)
+        agent.run_algorithm(alpha_factor = alpha_factor, gamma_factor = gamma_factor, num_episodes = num_episodes, max_steps = max_steps)
+        rewards["Linear Q-Learning"] = agent.algorithm.total_rewards
+        logging.info("Linear Q-Learning: {} weights, {} of {} episodes truncated at {} steps".format(agent.algorithm.weights.size, agent.algorithm.num_truncated, num_episodes, max_steps))
+        plot.plot_state_visits(agent.algorithm.total_state_visits, grid_size, num_episodes, "Linear Q-Learning total state visits (normalized)")
     elif (sys.argv[1] == "CUMU_REWARDS"):
         agent.set_algorithm(AgentAlgorithm.MONTE_CARLO)
-        agent.run_algorithm(gamma_factor = gamma_factor, num_episodes = num_episodes, epsilon_mod = 0.05)
+        agent.run_algorithm(gamma_factor = gamma_factor, num_episodes = num_episodes, epsilon_mod = 0.05, max_steps = max_steps)
         rewards["Monte Carlo"] = agent.algorithm.total_rewards
+        logging.info("Monte Carlo: {} of {} episodes truncated at {} steps".format(agent.algorithm.num_truncated, num_episodes, max_steps))
 
         agent.init_policy()
         agent.set_algorithm(AgentAlgorithm.SARSA)
-        agent.run_algorithm(alpha_factor = alpha_factor, gamma_factor = gamma_factor, epsilon_factor = 0.05, num_episodes = num_episodes)
+        agent.run_algorithm(alpha_factor = alpha_factor, gamma_factor = gamma_factor, epsilon_factor = 0.05, num_episodes = num_episodes, max_steps = max_steps)
         rewards["SARSA"] = agent.algorithm.total_rewards
+        logging.info("SARSA: {} of {} episodes truncated at {} steps".format(agent.algorithm.num_truncated, num_episodes, max_steps))
 
         agent.init_policy()
         agent.set_algorithm(AgentAlgorithm.Q_LEARNING)
-        agent.run_algorithm(alpha_factor = alpha_factor, gamma_factor = gamma_factor, num_episodes = num_episodes)
+        agent.run_algorithm(alpha_factor = alpha_factor, gamma_factor = gamma_factor, num_episodes = num_episodes, max_steps = max_steps)
         rewards["Q-Learning"] = agent.algorithm.total_rewards
+        logging.info("Q-Learning: {} of {} episodes truncated at {} steps".format(agent.algorithm.num_truncated, num_episodes, max_steps))
+        logging.info("Q-Learning: {} steps in the environment".format(agent.algorithm.num_interactions))
+
+        agent.init_policy()
+        agent.set_algorithm(AgentAlgorithm.Q_LEARNING)
+        agent.run_algorithm(alpha_factor = alpha_factor, gamma_factor = gamma_factor, num_episodes = num_episodes, max_steps = max_steps, planning_steps = planning_steps)
+        rewards["Dyna-Q"] = agent.algorithm.total_rewards
+        logging.info("Dyna-Q: {} steps in the environment".format(agent.algorithm.num_interactions))
+
+        agent.init_policy()
+        agent.set_algorithm(AgentAlgorithm.SARSA)
+        agent.run_algorithm(alpha_factor = alpha_factor, gamma_factor = gamma_factor, epsilon_factor = 0.05, num_episodes = num_episodes, max_steps = max_steps, lambda_factor = lambda_factor)
+        rewards["SARSA(λ)"] = agent.algorithm.total_rewards
+
+        agent.init_policy()
+        agent.set_algorithm(AgentAlgorithm.Q_LEARNING)
+        agent.run_algorithm(alpha_factor = alpha_factor, gamma_factor = gamma_factor, num_episodes = num_episodes, max_steps = max_steps, lambda_factor = lambda_factor)
+        rewards["Q(λ)"] = agent.algorithm.total_rewards
 
-        plot.plot_total_rewards(rewards, "Monte-Carlo vs. Q-Learning vs. SARSA total cumulative rewards per episode", alpha_factor, gamma_factor, num_episodes)
+        plot.plot_total_rewards(rewards, "Monte-Carlo vs. Q-Learning (with and without traces, Dyna-Q) vs. SARSA (with and without traces) total cumulative rewards per episode", alpha_factor, gamma_factor, num_episodes)
     else:
-        print("Error: incorrect parameter '{}'\n\t- Usage: python main.py <algorithm> (PI, VI, MC, SARSA, QLEARNING, CUMU_REWARDS)".format(sys.argv[1]))
+        print("Error: incorrect parameter '{}'\n\t- Usage: python main.py <algorithm> (PI, VI, SP, MC, SARSA, QLEARNING, LINEAR, CUMU_REWARDS)".format(sys.argv[1]))
         sys.exit()
 
     fps = 60
@@ -186,13 +235,13 @@ if __name__ == "__main__":
                         case pygame.K_SPACE:
                             action = agent.sample_action()
                         case pygame.K_LEFT:
-                            action = (-1, 0)
+                            action = encode_action((-1, 0))
                         case pygame.K_RIGHT:
-                            action = (1, 0)
+                            action = encode_action((1, 0))
                         case pygame.K_UP:
-                            action = (0, -1)
+                            action = encode_action((0, -1))
                         case pygame.K_DOWN:
-                            action = (0, 1)
+                            action = encode_action((0, 1))
                         case pygame.K_r:
                             sim_reset(school_env, agent)
                             action = None
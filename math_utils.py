@@ -1,9 +1,25 @@
-import numpy as np
+# The four grid moves (dx, dy), indexed by action id: up, down, left, right.
+ACTIONS: tuple[tuple[int, int], ...] = ((0, -1), (0, 1), (-1, 0), (1, 0))
 
-def tuple_addition(t1: tuple[any], t2: tuple[any]):
-    res = tuple(int(x) for x in (np.array(t1) + np.array(t2)))
+# Maps a move (dx, dy) to its action id.
+ACTION_INDEX: dict[tuple[int, int], int] = {action: i for i, action in enumerate(ACTIONS)}
 
-    return res
+def encode_state(grid_pos: tuple[int, int], grid_size: int) -> int:
+    """Flat state id of a grid position: s = y * grid_size + x."""
+    return grid_pos[1] * grid_size + grid_pos[0]
 
-def np_to_tuple(t: np.array):
-    return tuple(int(x) for x in t)
\ No newline at end of file
+def decode_state(state: int, grid_size: int) -> tuple[int, int]:
+    """Grid position (x, y) of a flat state id."""
+    return (int(state % grid_size), int(state // grid_size))
+
+def encode_action(action: tuple[int, int]) -> int:
+    """Action id of a move (dx, dy)."""
+    return ACTION_INDEX[action]
+
+def decode_action(action: int) -> tuple[int, int]:
+    """Move (dx, dy) of an action id."""
+    return ACTIONS[action]
+
+def tuple_view(table: dict[int, any], grid_size: int) -> dict[tuple[int, int], any]:
+    """Copy of a table keyed by flat state ids, keyed by (x, y) grid positions instead (e.g. for plotting)."""
+    return {decode_state(s, grid_size): val for s, val in table.items()}
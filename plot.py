@@ -3,6 +3,8 @@ import seaborn as sns
 import matplotlib.pyplot as plt
 from typing import Callable
 
+from math_utils import decode_action, tuple_view
+
 def plot_results(sarsa_values, q_values, sarsa_policy, q_policy, title="SARSA vs Q-Learning"):
     """
     Compares SARSA and Q-Learning by visualizing their reward values as heatmaps and overlaying arrows for policies.
@@ -43,10 +45,10 @@ def plot_total_rewards(rewards: dict[str, list[float]], title: str, alpha_factor
     plt.legend()
     plt.show()
 
-def plot_state_visits(grid: dict[tuple[int, int], int], grid_size: int, episode_length: int, title: str):
+def plot_state_visits(grid: dict[int, int], grid_size: int, episode_length: int, title: str):
     heatmap_data = np.zeros((grid_size, grid_size))
 
-    for (x, y), val in grid.items():
+    for (x, y), val in tuple_view(grid, grid_size).items():
         heatmap_data[(y, x)] = float(val) / episode_length
 
     plt.figure(figsize=(6, 5))  # Adjust figure size
@@ -56,21 +58,21 @@ def plot_state_visits(grid: dict[tuple[int, int], int], grid_size: int, episode_
     plt.show()
 
 # Plot a Policy Iteration Heatmap.
-def plot_pi_heatmap(grid_size: int, movement: dict[(int, int)], potential_rewards) -> None:
+def plot_pi_heatmap(grid_size: int, movement: dict[int, dict[int, float]], potential_rewards: dict[int, float]) -> None:
     plot_directional_heatmap("Policy Iteration Heatmap", grid_size, potential_rewards, movement, movement_cell_definition)
 
 # Plot a Value Iteration Heatmap.
-def plot_vi_heatmap(grid_size: int, optimal_actions: dict[(int, int)], potential_rewards: dict[(int, int)]) -> None:
+def plot_vi_heatmap(grid_size: int, optimal_actions: dict[int, int], potential_rewards: dict[int, float]) -> None:
     plot_directional_heatmap("Value Iteration Heatmap", grid_size, potential_rewards, optimal_actions, vi_cell_definition)
 
 # Plot a Policy Iteration Heatmap.
-def plot_sarsa_heatmap(grid_size: int, movement: dict[(int, int)], potential_rewards) -> None:
+def plot_sarsa_heatmap(grid_size: int, movement: dict[int, dict[int, float]], potential_rewards: dict[int, float]) -> None:
     plot_directional_heatmap("TD Sarsa Heatmap", grid_size, potential_rewards, movement, movement_cell_definition)
 
 # This function gives the definition of a cell for a movement dictionary Heatmap.
 # It is made a callback function in order to minimize duplicate code.
-def movement_cell_definition(x: int, y: int, arrow_size_multiplier: float, movement: dict[(int, int)]) -> None:
-    for action in movement[(x, y)]:
+def movement_cell_definition(x: int, y: int, arrow_size_multiplier: float, movement: dict[tuple[int, int], dict[int, float]]) -> None:
+    for action in map(decode_action, movement[(x, y)]):
         plt.arrow(x, y,
                   action[0] * arrow_size_multiplier,
                   action[1] * arrow_size_multiplier,
@@ -81,8 +83,12 @@ def movement_cell_definition(x: int, y: int, arrow_size_multiplier: float, movem
 
 # This function gives the definition of a cell in the Value Iteration Heatmap.
 # It is made a callback function in order to minimize duplicate code.
-def vi_cell_definition(x: int, y: int, arrow_size_multiplier: float, optimal_actions: dict[(int, int)]) -> None:
-    action = optimal_actions[(x, y)]
+def vi_cell_definition(x: int, y: int, arrow_size_multiplier: float, optimal_actions: dict[tuple[int, int], int]) -> None:
+    # Terminal cells have no optimal action.
+    if (x, y) not in optimal_actions:
+        return
+
+    action = decode_action(optimal_actions[(x, y)])
     plt.arrow(x, y,
               action[0] * arrow_size_multiplier,
               action[1] * arrow_size_multiplier,
@@ -92,9 +98,13 @@ def vi_cell_definition(x: int, y: int, arrow_size_multiplier: float, optimal_act
               ec='k')
 
 # The generalized code of plotting a directional heatmap. The cell_def_function is the callback function which defines the cell for a specific algorithm.
-def plot_directional_heatmap(title: str, grid_size: int, potential_rewards: dict[(int, int)], actions: dict[(int, int)], cell_def_function: Callable) -> None:
+# The tables are keyed by flat state ids and are converted to their (x, y) view for plotting.
+def plot_directional_heatmap(title: str, grid_size: int, potential_rewards: dict[int, float], actions: dict[int, any], cell_def_function: Callable) -> None:
     fig, ax = plt.subplots()
 
+    potential_rewards = tuple_view(potential_rewards, grid_size)
+    actions = tuple_view(actions, grid_size)
+
     rewards = [[0 for _ in range(grid_size)] for _ in range(grid_size)]
     for coordinates, reward in potential_rewards.items():
         rewards[coordinates[1]][coordinates[0]] = reward
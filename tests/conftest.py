@@ -0,0 +1,51 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# The modules live at the root of the repository, next to main.py.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cell import Cell
+from env import SchoolEnv
+
+def build_env(grid_size: int, agent_pos: tuple[int, int], target_pos: tuple[int, int], viruses: list[tuple[int, int]],
+              solids: list[tuple[int, int]]) -> SchoolEnv:
+    target = Cell(target_pos, 15.0, "exam.png", True)
+    env = SchoolEnv(agent_pos, target, grid_size)
+
+    env.register_object(target)
+    for pos in viruses:
+        env.register_object(Cell(pos, -4.0, "virus.png"))
+    for pos in solids:
+        env.register_object(Cell(pos, 0.0, None, False, True))
+
+    env.reset()
+    env.compile()
+
+    return env
+
+@pytest.fixture
+def default_env() -> SchoolEnv:
+    """The map of main.py."""
+    return build_env(8, (2, 2), (7, 7), [(4, 1), (1, 5), (3, 3), (5, 5), (3, 7), (6, 6), (0, 0)], [(1, 1), (2, 1), (3, 1)])
+
+@pytest.fixture
+def random_env():
+    """Builds a map of the given size with the target near the far corner and random viruses and walls."""
+    def build(grid_size: int, seed: int, num_viruses: int = None, num_solids: int = None) -> SchoolEnv:
+        num_viruses = grid_size // 4 if num_viruses is None else num_viruses
+        num_solids = grid_size // 4 if num_solids is None else num_solids
+
+        rng = np.random.default_rng(seed)
+        agent_pos, target_pos = (2, 2), (grid_size * 3 // 4, grid_size * 3 // 4)
+
+        cells = rng.choice(grid_size * grid_size, size=num_viruses + num_solids, replace=False).tolist()
+        cells = [(s % grid_size, s // grid_size) for s in cells]
+        viruses = [pos for pos in cells[:num_viruses] if pos not in (agent_pos, target_pos)]
+        solids = [pos for pos in cells[num_viruses:] if pos not in (agent_pos, target_pos)]
+
+        return build_env(grid_size, agent_pos, target_pos, viruses, solids)
+
+    return build
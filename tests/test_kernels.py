@@ -0,0 +1,43 @@
+import pytest
+
+from agent import Agent, AgentAlgorithm
+from algorithms import kernels
+from env import SchoolEnv
+
+ALGORITHMS = [
+    (AgentAlgorithm.Q_LEARNING, dict(alpha_factor=0.1)),
+    (AgentAlgorithm.SARSA, dict(alpha_factor=0.1, epsilon_factor=0.05)),
+    (AgentAlgorithm.MONTE_CARLO, dict(epsilon_mod=0.05)),
+]
+
+def run_backend(env: SchoolEnv, algorithm: AgentAlgorithm, backend: str, max_steps: int, **kwargs) -> Agent:
+    agent = Agent(env.get_obs, (2, 2), env.grid_size, model_cb=env.transition_model)
+    agent.set_algorithm(algorithm)
+    agent.run_algorithm(gamma_factor=0.9, num_episodes=200, seed=3, max_steps=max_steps, backend=backend, **kwargs)
+
+    return agent
+
+def assert_backends_match(env: SchoolEnv, algorithm: AgentAlgorithm, max_steps: int, kwargs: dict) -> None:
+    python = run_backend(env, algorithm, "python", max_steps, **kwargs)
+    jit = run_backend(env, algorithm, "jit", max_steps, **kwargs)
+
+    assert {s: dict(p) for s, p in jit.policy.items()} == {s: dict(p) for s, p in python.policy.items()}
+    assert jit.algorithm.total_rewards == python.algorithm.total_rewards
+    assert jit.algorithm.total_state_visits == python.algorithm.total_state_visits
+
+@pytest.mark.parametrize("max_steps", [None, 30])
+@pytest.mark.parametrize("algorithm, kwargs", ALGORITHMS)
+def test_jit_backend_matches_python(default_env, algorithm, kwargs, max_steps):
+    # Without Numba this runs the kernels as plain Python.
+    assert_backends_match(default_env, algorithm, max_steps, kwargs)
+
+@pytest.mark.parametrize("algorithm, kwargs", ALGORITHMS)
+def test_compiled_kernels_match_python(default_env, algorithm, kwargs):
+    pytest.importorskip("numba")
+    assert kernels.JIT_AVAILABLE
+
+    assert_backends_match(default_env, algorithm, 30, kwargs)
+
+def test_jit_backend_rejects_traces(default_env):
+    with pytest.raises(ValueError):
+        run_backend(default_env, AgentAlgorithm.Q_LEARNING, "jit", None, alpha_factor=0.1, lambda_factor=0.5)
@@ -0,0 +1,40 @@
+import pytest
+
+from agent import Agent, AgentAlgorithm
+from env import SchoolEnv
+
+def run_linear(env: SchoolEnv, seed: int, **kwargs) -> Agent:
+    agent = Agent(env.get_obs, (2, 2), env.grid_size, model_cb=env.transition_model)
+    agent.set_algorithm(AgentAlgorithm.LINEAR_TD)
+    agent.run_algorithm(alpha_factor=0.1, gamma_factor=0.99, num_episodes=300, max_steps=20 * env.grid_size, seed=seed, **kwargs)
+
+    return agent
+
+def greedy_steps(env: SchoolEnv, agent: Agent) -> int:
+    """The number of steps the greedy policy takes from the start state to a terminal state, None if it gets stuck."""
+    model = env.transition_model()
+    s = agent.state
+
+    for steps in range(4 * env.grid_size):
+        if model.terminal[s]:
+            return steps
+        s = int(model.next_state[s, agent.algorithm.greedy_action(s)])
+
+    return None
+
+@pytest.mark.parametrize("grid_size, seed", [(64, 0), (64, 1), (128, 0)])
+def test_greedy_policy_reaches_the_target(random_env, grid_size, seed):
+    env = random_env(grid_size, seed)
+    agent = run_linear(env, seed)
+
+    steps = greedy_steps(env, agent)
+    assert steps is not None
+    # The target is at (3/4, 3/4) of the grid, the start at (2, 2): the shortest walk is about as long as the Manhattan distance.
+    assert steps <= 2 * (grid_size * 3 // 4 - 2) + 8
+    assert agent.algorithm.num_truncated < 10
+
+@pytest.mark.parametrize("method", ["q_learning", "sarsa"])
+def test_default_map(default_env, method):
+    agent = run_linear(default_env, 0, method=method)
+
+    assert greedy_steps(default_env, agent) is not None
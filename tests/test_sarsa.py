@@ -0,0 +1,44 @@
+import pytest
+
+from agent import Agent, AgentAlgorithm
+from env import SchoolEnv
+
+GAMMA: float = 0.9
+
+def greedy_return(env: SchoolEnv, agent: Agent) -> float:
+    """The discounted return of following the most probable action of the agent's policy from its start state."""
+    model = env.transition_model()
+    s, total, discount = agent.state, 0.0, 1.0
+
+    for _ in range(4 * env.grid_size * env.grid_size):
+        if model.terminal[s]:
+            break
+
+        action = max(agent.policy[s], key=agent.policy[s].get)
+        total += discount * float(model.reward[s, action])
+        discount *= GAMMA
+        s = int(model.next_state[s, action])
+
+    return total
+
+def run_sarsa(env: SchoolEnv, seed: int, **kwargs) -> Agent:
+    agent = Agent(env.get_obs, (2, 2), env.grid_size, model_cb=env.transition_model)
+    agent.set_algorithm(AgentAlgorithm.SARSA)
+    agent.run_algorithm(alpha_factor=0.1, gamma_factor=GAMMA, epsilon_factor=0.05, num_episodes=200, max_steps=1000, seed=seed, **kwargs)
+
+    return agent
+
+def solve(env: SchoolEnv) -> Agent:
+    agent = Agent(env.get_obs, (2, 2), env.grid_size, model_cb=env.transition_model)
+    agent.set_algorithm(AgentAlgorithm.VALUE_ITERATION)
+    agent.run_algorithm(gamma_factor=GAMMA, theta_factor=1e-9)
+
+    return agent
+
+@pytest.mark.parametrize("seed", range(5))
+def test_traces_learn_the_same_greedy_policy(default_env, seed):
+    plain = run_sarsa(default_env, seed)
+    traced = run_sarsa(default_env, seed, lambda_factor=0.8)
+
+    assert greedy_return(default_env, traced) == pytest.approx(greedy_return(default_env, plain))
+    assert greedy_return(default_env, traced) == pytest.approx(greedy_return(default_env, solve(default_env)))
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from agent import Agent, AgentAlgorithm
+from env import SchoolEnv
+
+GAMMA: float = 0.9
+THETA: float = 1e-10
+
+def solve(env: SchoolEnv, algorithm: AgentAlgorithm, **kwargs) -> Agent:
+    agent = Agent(env.get_obs, (2, 2), env.grid_size, model_cb=env.transition_model)
+    agent.set_algorithm(algorithm)
+    agent.run_algorithm(gamma_factor=GAMMA, theta_factor=THETA, **kwargs)
+
+    return agent
+
+def assert_solutions_match(env: SchoolEnv) -> None:
+    vi = solve(env, AgentAlgorithm.VALUE_ITERATION, backend="numpy")
+    sp = solve(env, AgentAlgorithm.SHORTEST_PATH)
+
+    np.testing.assert_allclose(sp.algorithm.values, vi.algorithm.values, atol=1e-6)
+    assert sp.algorithm.optimal_actions.keys() == vi.algorithm.optimal_actions.keys()
+
+    # The greedy actions have to be the same, except between actions whose values are equal up to the tolerance.
+    model = env.transition_model()
+    for s, action in vi.algorithm.optimal_actions.items():
+        moves = model.next_state[s] != s
+        action_values = np.where(moves, model.reward[s] + GAMMA * vi.algorithm.values[model.next_state[s]], -np.inf)
+        ties = np.flatnonzero(action_values >= action_values.max() - 1e-6)
+
+        if len(ties) == 1:
+            assert sp.algorithm.optimal_actions[s] == action
+        else:
+            assert sp.algorithm.optimal_actions[s] in ties
+
+def test_shortest_path_matches_value_iteration(default_env):
+    assert_solutions_match(default_env)
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_shortest_path_matches_value_iteration_on_random_maps(random_env, seed):
+    assert_solutions_match(random_env(24, seed))
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from agent import Agent, AgentAlgorithm
+from cell import Cell
+from env import SchoolEnv
+
+THETA: float = 1e-6
+
+def solve(env: SchoolEnv, backend: str, gamma: float) -> Agent:
+    agent = Agent(env.get_obs, (2, 2), env.grid_size, model_cb=env.transition_model)
+    agent.set_algorithm(AgentAlgorithm.VALUE_ITERATION)
+    agent.run_algorithm(gamma_factor=gamma, theta_factor=THETA, backend=backend)
+
+    return agent
+
+def rewarding_env(grid_size: int, seed: int) -> SchoolEnv:
+    """A map with non-terminal cells of positive reward, that the agent can circle instead of reaching the target."""
+    rng = np.random.default_rng(seed)
+    target = Cell((grid_size - 1, grid_size - 1), 15.0, "exam.png", True)
+    env = SchoolEnv((2, 2), target, grid_size)
+    env.register_object(target)
+
+    cells = [(s % grid_size, s // grid_size) for s in rng.choice(grid_size * grid_size - 1, size=2 * grid_size, replace=False).tolist()]
+    for i, pos in enumerate(pos for pos in cells if pos != (2, 2)):
+        env.register_object(Cell(pos, 1.0 if i % 2 == 0 else -4.0, "virus.png"))
+
+    env.reset()
+    env.compile()
+
+    return env
+
+def assert_prioritized_matches_numpy(env: SchoolEnv, gamma: float) -> None:
+    synchronous = solve(env, "numpy", gamma)
+    prioritized = solve(env, "prioritized", gamma)
+
+    # Both stop within theta of the fixed point, so their values differ by at most theta / (1 - gamma) from each other.
+    np.testing.assert_allclose(prioritized.algorithm.values, synchronous.algorithm.values, atol=2 * THETA / (1.0 - gamma))
+    assert prioritized.algorithm.num_backups < synchronous.algorithm.num_backups
+
+def test_prioritized_sweeping_on_default_map(default_env):
+    assert_prioritized_matches_numpy(default_env, 0.9)
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_prioritized_sweeping_on_random_maps(random_env, seed):
+    assert_prioritized_matches_numpy(random_env(32, seed), 0.9)
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_prioritized_sweeping_with_rewarding_cells(seed):
+    assert_prioritized_matches_numpy(rewarding_env(30, seed), 0.99)